@@ -1,76 +1,411 @@
-from datetime import date, time, datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from dateutil.relativedelta import relativedelta
-import json
 import os
-import pkg_resources
-import sys
+import threading
 
+from roundtable_report import build
+from roundtable_report import config
+from roundtable_report import executor
 from roundtable_report import functions as rrf
+from roundtable_report import ingest
+from roundtable_report import instrument
+from roundtable_report import storage
+from roundtable_report.instrument import Trace, print_log
 
 
-def print_log(msg):
-    print(f"{datetime.now(): %Y-%m-%d %H:%M:%S}: {msg}")
+def main(directory, mode, fmt='parquet', reference_cache=True,
+         refresh_reference=False, query_workers=4, render_workers=1,
+         incremental=False, refresh=None, stream=False, keep_extract=False,
+         pushdown_sql=False, trace_memory=False, profile=None, force=False,
+         report_ids=None, memory_limit=None, chunksize=storage.CHUNKSIZE,
+         months=None):
+    # Load and validate the JSON files, compiling the plan of every report
+    plans = config.load().reports
+    if report_ids is not None:
+        plans = {id: plan for id, plan in plans.items() if id in report_ids}
 
+    # Export directory creation; a backfill queries the combined window of
+    # its report months once, into its own folder, and builds each month's
+    # reports in that month's folder from the same aggregates
+    backfill = months is not None
+    months = sorted(months or [rrf.report_month()])
+    params = rrf.backfill_params(months)
+    export_path = directory
+    month_directories = {
+        month: os.path.join(export_path, 'data', month.strftime('%Y-%m'))
+        for month in months}
+    if backfill:
+        directory = os.path.join(
+            export_path, 'data', 'backfill',
+            f"{months[0]:%Y-%m}_{months[-1]:%Y-%m}")
+    else:
+        directory = month_directories[months[0]]
+    for path in {directory, *month_directories.values()}:
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+    print(f"Destination directory: {directory}")
 
-def main(directory, mode):
-    # Import report parameters
-    paramfile = pkg_resources.resource_filename(
-        'roundtable_report', 'params.json')
-    with open(paramfile, 'r') as infile:
-        param = json.load(infile)
+    # Record the stages of the run to a JSON trace
+    trace = Trace(memory=trace_memory)
+    trace_path = os.path.join(
+        directory, 'trace', f"{trace.started:%Y%m%d-%H%M%S}.json")
+    pool = ProcessPoolExecutor(render_workers) if render_workers > 1 else None
+    if pool is not None:
+        # Start the render workers before the query threads, so that none of
+        # them is forked while one of those threads holds a lock
+        pool.submit(os.getpid).result()
+    scans = rrf.plan_scans(plans)
+    exports = None
+    try:
+        # Run SQL queries, split into month shards, and export data to a
+        # local datafile on a background thread (streamed and pushed-down
+        # runs query while generating the report images)
+        if mode in [0, 1] and not (stream or pushdown_sql):
+            # The datafiles most reports are built from are fetched first, so
+            # that the longest chains of pivots and renders start earliest
+            queries = sorted(scans, key=lambda x: len(scans[x]), reverse=True)
+            print_log(f"Starting {', '.join(queries)} queries...")
+            # Set once the reports stop reading the datafiles, so that the
+            # queries still running give up
+            stop = threading.Event()
+            exports = executor.background(export_datafiles(
+                queries, export_path, directory, fmt, query_workers,
+                incremental, refresh, trace, chunksize, params, stop), stop)
+            if mode == 1:
+                for query in exports:
+                    pass
 
-    # Export directory creation
-    mo = datetime.combine(date.today(), time.min) - \
-        relativedelta(days=datetime.now().day - 1) - \
-        relativedelta(months=1)
-    directory = os.path.join(directory, 'data', mo.strftime('%Y-%m'))
-    if not os.path.exists(directory):
-        os.makedirs(directory, exist_ok=True)
-    print(f"Destination directory: {directory}")
+        # Generate report images, scanning each datafile once for all of the
+        # reports built from it; in a full run, as soon as the datafile is
+        # exported, while the other queries are still running
+        if mode in [0, 2]:
+            reference = rrf.ReferenceCache(
+                directory if reference_cache else None, refresh_reference)
+            data = config.load().data
+            manifests = {
+                month: build.load_manifest(path)
+                for month, path in month_directories.items()}
+            from_datafile = not (stream or pushdown_sql)
+            for datafile in exports if exports is not None else list(scans):
+                reports = scans[datafile]
+                # Report months to build each report for
+                stale = {id: list(months) for id in reports}
+                if from_datafile and not (force or refresh_reference):
+                    # Skip the report months already built from the same
+                    # inputs
+                    for id, plan in list(reports.items()):
+                        inputs = build.report_inputs(
+                            directory, plan, data, reference)
+                        stale[id] = [
+                            month for month in months
+                            if not build.is_current(
+                                manifests[month], month_directories[month],
+                                plan, inputs)]
+                        for month in months:
+                            if month not in stale[id]:
+                                trace.event(
+                                    'skip', report=id,
+                                    month=f"{month:%Y-%m}")
+                        if not stale[id]:
+                            del reports[id]
+                    if not reports:
+                        continue
+                with trace.stage('scan', datafile=datafile) as event:
+                    tables = scan(
+                        directory, datafile, reports, reference, trace, event,
+                        fmt, query_workers, stream, keep_extract,
+                        pushdown_sql, memory_limit, chunksize,
+                        sorted(set().union(*(stale[id] for id in reports))))
+                for id, plan in reports.items():
+                    table = tables.pop(id)
+                    profile_path = os.path.join(
+                        directory, 'trace', f"{id}.prof")
+                    with instrument.profile(profile_path, id == profile):
+                        for month in stale[id]:
+                            build_report(
+                                plan, month_directories[month], table,
+                                manifests[month], data, reference, trace,
+                                pool, force, from_datafile, month, directory)
+                    if id == profile:
+                        print_log(f"Profile saved to {profile_path}")
+    finally:
+        if exports is not None:
+            exports.close()
+        if pool is not None:
+            pool.shutdown()
+        trace.save(trace_path)
+        print_log(f"Trace saved to {trace_path}")
 
-    # Run SQL queries and export data to a local .csv file
-    if mode in [0, 1]:
-        queries = list(set([param[id]['datafile'] for id in param]))
-        for query in queries:
-            print_log(f"Starting {query} query...")
-            table = rrf.query_data(query)
-            print_log("Query complete!")
-            print_log(f"Copying to local file '{query}.csv'...")
-            rrf.export_data(table, directory, query)
-            print_log(f"File created!")
-
-    # Generate report images
-    if mode in [0, 2]:
-        for id, params in param.items():
-            print(id)
-            print_log("Starting table pivot...")
-            pivot_tables = rrf.pivot_data(id, params, directory)
-            print_log("Table pivot complete!")
-            print_log("Starting visualization...")
-            rrf.vis_data(params, directory, pivot_tables)
-            print_log("Visualization complete!")
 
+def export_datafiles(queries, export_path, directory, fmt, query_workers,
+                     incremental, refresh, trace, chunksize=storage.CHUNKSIZE,
+                     params=None, stop=None):
+    """
+    Runs the SQL queries, split into month shards, and exports each one to a
+    local datafile, recording the run's 'query' stage
 
-if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        print(
-            "An export path is required; please specify a directory to",
-            "export data to as an argument to the module call...exiting")
-        exit()
-    directory = sys.argv[1]
-    if not os.path.exists(directory):
-        print(f"Path {directory} does not exist...exiting")
-        exit()
+    :returns: an iterator of query names, yielded as each datafile is created
+    """
+    with trace.stage('query', queries=len(queries)) as event:
+        if incremental:
+            # Only fetch the months missing from (or stale in) the rolling
+            # store
+            store = os.path.join(export_path, 'data', 'store')
+            if refresh:
+                ingest.mark_stale(store, queries, refresh)
+            for query, months in ingest.ingest(
+                    queries, store, directory, fmt, query_workers,
+                    refresh=refresh == [], params=params,
+                    chunksize=chunksize, stop=stop):
+                trace.event('export', event, query=query, months=len(months))
+                yield query
+        else:
+            for query in executor.run_queries(
+                    queries, directory, fmt, query_workers, params,
+                    chunksize=chunksize, stop=stop):
+                trace.event('export', event, query=query)
+                yield query
+
+
+def build_report(plan, directory, table, manifest, data, reference, trace,
+                 pool, force, from_datafile, month=None, source=None):
+    """
+    Pivots an aggregated table for a report month and renders its images,
+    unless the same pivot tables were already rendered, and records the
+    report in the month's build manifest (the datafile is read from the
+    source folder, the month folder if not given)
+    """
+    label = {} if month is None else {'month': f"{month:%Y-%m}"}
+    with trace.stage('pivot', report=plan.id, **label) as event:
+        event['rows_in'] = len(table)
+        pivot_tables = rrf.build_pivots(plan, directory, table, month)
+        event['tables'] = len(pivot_tables)
+    inputs = build.report_inputs(
+        source or directory, plan, data, reference, from_datafile)
+    pivot = build.pivot_hash(pivot_tables)
+    if not force and build.is_rendered(
+            manifest, directory, plan, inputs, pivot):
+        trace.event('skip render', report=plan.id, **label)
+        failures = {}
+    else:
+        with trace.stage('render', report=plan.id, **label) as event:
+            failures = rrf.vis_data(plan, directory, pivot_tables, pool)
+            event['images'] = sum(
+                len(table.index) > 0 for table in pivot_tables.values()) - \
+                len(failures)
+            event['failures'] = len(failures)
+    for label, error in failures.items():
+        print_log(f"Failed to render '{label}': {error}")
+    # Reports with a failed image are built again on the next run
+    if not failures:
+        build.record(
+            manifest, directory, plan, inputs, pivot, pivot_tables)
+        build.save_manifest(directory, manifest)
+
+
+def scan(directory, datafile, reports, reference, trace, event, fmt,
+         query_workers, stream, keep_extract, pushdown_sql,
+         memory_limit=None, chunksize=storage.CHUNKSIZE, months=None):
+    """
+    Aggregates the source data of every report built from a datafile over
+    the windows of the report months, counting the chunks and rows read in
+    the scan's trace event; beyond memory_limit (in MB), the running
+    aggregates are spilled to the directory's .spill folder
+
+    :returns: a dict of aggregated pandas dataframes keyed by report id
+    """
+    if pushdown_sql:
+        # Only the aggregated rows leave the database
+        from roundtable_report import pushdown
+
+        tables = pushdown.aggregate_query(
+            datafile, reports, reference, query_workers)
     else:
-        if len(sys.argv) > 2:
-            if sys.argv[2].lower() == 'query':
-                main(directory, 1)
-            elif sys.argv[2].lower() == 'vis':
-                main(directory, 2)
-            else:
-                print(f"Optional argument '{sys.argv[2]}' not recognized.\n"
-                      "Usage: python -m roundtable_report {EXPORT_PATH} "
-                      "['query', 'vis']")
-                exit()
+        # Only the months within the reports' windows are read
+        windows = rrf.scan_windows(reports, months)
+        if stream:
+            # Aggregate the query results as they arrive instead of reading
+            # them back from a datafile (written whole if it is kept)
+            params = rrf.backfill_params(months) if months else None
+            sources = [executor.stream_query(
+                datafile, query_workers, params,
+                windows=None if keep_extract else windows,
+                chunksize=chunksize)]
+            if keep_extract:
+                sources.insert(0, storage.tee_chunks(
+                    sources[0], directory, datafile, fmt))
         else:
-            main(directory, 0)
+            sources = [storage.read_chunks(
+                directory, datafile, columns=rrf.report_union(reports),
+                chunksize=chunksize, windows=windows)]
+        try:
+            tables = rrf.aggregate_chunks(
+                trace.chunks(sources[0], event, datafile=datafile), reports,
+                reference, memory_limit, os.path.join(directory, '.spill'),
+                months)
+        finally:
+            # Closed explicitly, outermost first, as the traceback of a
+            # failed scan keeps them alive: this stops the fetch threads of
+            # a streamed query and finalizes a kept extract
+            for source in sources:
+                source.close()
+    event['rows_out'] = sum(len(table) for table in tables.values())
+
+    return tables
+
+
+def month(value):
+    """
+    Validates a '%Y-%m' command line argument
+    """
+    try:
+        datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a YYYY-MM month")
+    return value
+
+
+def month_range(first, last=None):
+    """
+    :param first: first month ('%Y-%m')
+    :param last: last month ('%Y-%m', optional, defaults to first)
+    :returns: list of datetimes of the first day of each month from first to
+              last
+    """
+    start = datetime.strptime(first, '%Y-%m')
+    end = datetime.strptime(last or first, '%Y-%m')
+    months = []
+    while start <= end:
+        months.append(start)
+        start += relativedelta(months=1)
+
+    return months
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m roundtable_report',
+        description="Generates the monthly ridership roundtable report")
+    parser.add_argument(
+        'directory', help="export path; data is written to its data/ folder")
+    parser.add_argument(
+        'mode', nargs='?', type=str.lower, choices=['query', 'vis'],
+        help="only run the SQL queries ('query') or the images ('vis')")
+    parser.add_argument(
+        '--format', dest='fmt', choices=storage.FORMATS, default='parquet',
+        help="datafile format used for query exports (default: parquet)")
+    parser.add_argument(
+        '--no-reference-cache', dest='reference_cache', action='store_false',
+        help="don't keep a copy of the reference tables in the month folder")
+    parser.add_argument(
+        '--refresh-reference', action='store_true',
+        help="reload the reference tables from the database")
+    parser.add_argument(
+        '--query-workers', type=int, default=4,
+        help="number of month shards queried at once (default: 4)")
+    parser.add_argument(
+        '--render-workers', type=int, default=1,
+        help="number of processes rendering images (default: 1)")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="only query the months missing from the rolling month store")
+    parser.add_argument(
+        '--refresh', nargs='*', metavar='YYYY-MM', type=month,
+        help="query these months again (all months if none are given); "
+             "implies --incremental")
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="aggregate the query results as they arrive, without writing "
+             "datafiles (full runs only)")
+    parser.add_argument(
+        '--keep-extract', action='store_true',
+        help="also write the datafiles when streaming")
+    parser.add_argument(
+        '--pushdown', dest='pushdown_sql', action='store_true',
+        help="aggregate each report in the database, without writing "
+             "datafiles (full runs only)")
+    parser.add_argument(
+        '--trace-memory', action='store_true',
+        help="record the peak memory allocated in each stage with "
+             "tracemalloc (slower)")
+    parser.add_argument(
+        '--profile', metavar='REPORT_ID',
+        help="capture a cProfile of the pivot and render stages of a report")
+    parser.add_argument(
+        '--force', action='store_true',
+        help="rebuild every report, even those whose inputs are unchanged")
+    parser.add_argument(
+        '--reports', nargs='+', metavar='REPORT_ID',
+        help="only build these reports (and only run the queries they need)")
+    parser.add_argument(
+        '--memory-limit', type=float, metavar='MB',
+        help="memory ceiling of the running aggregates of a datafile scan, "
+             "spilled to disk beyond it (default: unbounded)")
+    parser.add_argument(
+        '--chunksize', type=int, default=storage.CHUNKSIZE, metavar='N',
+        help="number of rows per chunk fetched from the database or read "
+             f"from a datafile (default: {storage.CHUNKSIZE})")
+    parser.add_argument(
+        '--backfill', nargs='+', metavar='YYYY-MM', type=month,
+        help="build the reports of every month from the first to the last "
+             "month given, querying and aggregating their windows once")
+
+    args = parser.parse_args(argv)
+    if args.stream and args.mode is not None:
+        parser.error("--stream only applies to full runs")
+    if args.stream and (args.incremental or args.refresh is not None):
+        parser.error("--stream can't be combined with --incremental")
+    if args.pushdown_sql and args.mode is not None:
+        parser.error("--pushdown only applies to full runs")
+    if args.pushdown_sql and (args.stream or args.incremental or
+                              args.refresh is not None):
+        parser.error(
+            "--pushdown can't be combined with --stream or --incremental")
+    if args.keep_extract and not args.stream:
+        parser.error("--keep-extract requires --stream")
+    if args.chunksize <= 0:
+        parser.error("--chunksize must be positive")
+    if args.memory_limit is not None and args.memory_limit <= 0:
+        parser.error("--memory-limit must be positive")
+    if args.backfill is not None:
+        if len(args.backfill) > 2:
+            parser.error("--backfill takes a first and a last month")
+        if args.backfill[-1] < args.backfill[0]:
+            parser.error("--backfill months must be in order")
+        if args.pushdown_sql or args.incremental or \
+                args.refresh is not None:
+            parser.error(
+                "--backfill can't be combined with --pushdown or "
+                "--incremental")
+    if args.profile is not None and args.mode == 'query':
+        parser.error("--profile doesn't apply to 'query' runs")
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.exists(args.directory):
+        print(f"Path {args.directory} does not exist...exiting")
+        exit()
+    # Fail on a bad configuration before anything is queried
+    try:
+        reports = config.load().reports
+    except config.ConfigError as e:
+        print(e)
+        exit(1)
+    unknown = [
+        id for id in (args.reports or []) + [args.profile]
+        if id is not None and id not in reports]
+    if unknown:
+        print(f"{', '.join(unknown)} not in params.json...exiting")
+        exit(1)
+    modes = {None: 0, 'query': 1, 'vis': 2}
+    main(args.directory, modes[args.mode], args.fmt, args.reference_cache,
+         args.refresh_reference, args.query_workers, args.render_workers,
+         args.incremental or args.refresh is not None, args.refresh,
+         args.stream, args.keep_extract, args.pushdown_sql, args.trace_memory,
+         args.profile, args.force, args.reports, args.memory_limit,
+         args.chunksize, args.backfill and month_range(*args.backfill))
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+from roundtable_report import storage
+
+# Format of the spill files; Arrow IPC keeps the dtypes and is the cheapest
+# to write and read back
+SPILL_FORMAT = 'arrow'
+
+
+class Accumulator:
+    """
+    Folds a report's partial aggregates into a running aggregate as they
+    arrive
+
+    The running aggregate is partitioned by the month of its service_date
+    (the last group-by column), so that folding and merging never handle
+    more than a month of groups at once. A month's partials are buffered
+    until they hold as many rows as its running aggregate and then folded
+    into it. Given a memory ceiling, the folded months are spilled to files,
+    oldest first, whenever the running aggregate and buffered partials
+    outgrow it; each month is merged with its spills once the result is
+    requested.
+
+    :param group_by: list of the columns the partials are indexed by, ending
+                     with 'service_date'
+    :param memory_mb: memory ceiling of the running aggregate and buffered
+                      partials in MB (optional, unbounded if not given)
+    :param spill_directory: folder to write the spill files to (optional,
+                            defaults to the system's temporary folder)
+    """
+
+    def __init__(self, group_by, memory_mb=None, spill_directory=None):
+        self.group_by = list(group_by)
+        self.memory_mb = memory_mb
+        self.spill_directory = spill_directory
+        # Running aggregate, buffered partials and spill file names, keyed by
+        # month
+        self.running = {}
+        self.pending = {}
+        self.spills = {}
+        # Bytes per row of the running aggregate, measured on each fold
+        self.row_bytes = None
+        self._spill_path = None
+
+    def add(self, partial):
+        """
+        Adds a partial aggregate, folding (and spilling) the running aggregate
+        when due
+
+        :param partial: output of the aggregate_chunk function
+        """
+        dates = partial.index.get_level_values(-1)
+        months = dates.year * 100 + dates.month
+        touched = set(months.unique())
+        for month in touched:
+            piece = partial if len(touched) == 1 else \
+                partial[months == month]
+            self.pending.setdefault(month, []).append(piece)
+            if sum(map(len, self.pending[month])) >= \
+                    len(self.running.get(month, ())):
+                self._fold(month)
+        if self._over_limit():
+            # Spill the months the partial didn't touch first, oldest first,
+            # as the source data usually arrives in service_date order
+            for month in sorted(
+                    self.running, key=lambda x: (x in touched, x)):
+                self._fold(month)
+                self._spill(month)
+                if not self._over_limit():
+                    break
+
+    def result(self):
+        """
+        Merges each month of the running aggregate with its spills and
+        removes the spill files
+
+        :returns: pandas dataframe of rides sums, in month order, with a
+                  column per group_by column
+        """
+        try:
+            tables = []
+            months = set(self.running) | set(self.pending) | set(self.spills)
+            for month in sorted(months):
+                self._fold(month)
+                parts = [
+                    pd.concat(storage.read_chunks(
+                        self._spill_path, name, fmt=SPILL_FORMAT))
+                    .set_index(self.group_by)
+                    for name in self.spills.get(month, [])]
+                if month in self.running:
+                    parts.append(self.running.pop(month))
+                tables.append(self._merge(parts).reset_index())
+            if not tables:
+                return pd.DataFrame(columns=self.group_by + ['rides'])
+
+            # The months hold distinct groups; they are concatenated as
+            # columns, as concatenating their indexes is far more costly
+            return pd.concat(tables, ignore_index=True)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Discards the running aggregate and removes the spill files
+        """
+        self.running = {}
+        self.pending = {}
+        self.spills = {}
+        if self._spill_path is not None:
+            shutil.rmtree(self._spill_path, ignore_errors=True)
+            self._spill_path = None
+            if self.spill_directory is not None:
+                try:
+                    os.rmdir(self.spill_directory)
+                except OSError:
+                    # Still holds the spill files of other accumulators
+                    pass
+
+    def _merge(self, parts):
+        """
+        :param parts: list of pandas dataframes of rides sums indexed by the
+                      group_by columns
+        :returns: the rides sums of the parts, aggregated
+        """
+        if len(parts) == 1:
+            return parts[0]
+        return pd.concat(parts) \
+            .groupby(level=self.group_by) \
+            .agg({'rides': 'sum'})
+
+    def _over_limit(self):
+        """
+        :returns: whether the running aggregate and buffered partials are
+                  estimated to outgrow the memory ceiling
+        """
+        if self.memory_mb is None or self.row_bytes is None:
+            return False
+        rows = sum(map(len, self.running.values())) + \
+            sum(len(piece) for pieces in self.pending.values()
+                for piece in pieces)
+        return rows * self.row_bytes > self.memory_mb * 2**20
+
+    def _fold(self, month):
+        """
+        Aggregates a month's buffered partials into its running aggregate
+        """
+        pieces = self.pending.pop(month, [])
+        if not pieces:
+            return
+        if month in self.running:
+            pieces.insert(0, self.running[month])
+        self.running[month] = self._merge(pieces)
+        if len(self.running[month]) and self.memory_mb is not None:
+            self.row_bytes = \
+                self.running[month].memory_usage(deep=True).sum() / \
+                len(self.running[month])
+
+    def _spill(self, month):
+        """
+        Writes a month of the running aggregate to a spill file
+        """
+        if self._spill_path is None:
+            if self.spill_directory is not None:
+                os.makedirs(self.spill_directory, exist_ok=True)
+            self._spill_path = tempfile.mkdtemp(
+                prefix='spill-', dir=self.spill_directory)
+        names = self.spills.setdefault(month, [])
+        names.append(f"{month}-{len(names)}")
+        storage.write_chunks(
+            iter([self.running.pop(month).reset_index()]), self._spill_path,
+            names[-1], SPILL_FORMAT)
@@ -0,0 +1,423 @@
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from roundtable_report import config
+from roundtable_report import functions as rrf
+from roundtable_report.resources import CONFIG_ENV
+from roundtable_report.storage import FORMATS
+
+# Rail lines reported by name in the seg column (bus rows use route numbers)
+RAIL_LINES = [
+    'Red', 'Blue', 'Brown', 'Green', 'Orange', 'Pink', 'Purple', 'Yellow']
+ROUTE_GROUPS = ['A', 'B', 'C', 'D']
+STUDENT_GROUPS = ['Student Card', 'Student 2 Ride', 'Student Cash']
+FINANCE_CODES = list(range(100, 140))
+FARE_PRODUCTS = [f"Product {i}" for i in range(15)]
+YOY_TITLES = {'diff': 'YOY Value Change', 'pct_diff': 'YOY Percent Change'}
+
+# Synthetic stand-ins of the production queries, following the column
+# contract in docs/json-files.rst
+QUERIES = {
+    'fare-media-ridership': """
+    select type, service_date, day_type, hr, seg, media, finance_code, rides
+    from fare_media
+    where replace(service_date, '-', '') between :from_date and :to_date""",
+    'ventra-ridership': """
+    select type, service_date, day_type, fare_prod_name, rides
+    from ventra
+    where replace(service_date, '-', '') between :from_date and :to_date""",
+    'daily-ridership': """
+    select type, service_date, day_type, hr, rides
+    from daily
+    where replace(service_date, '-', '') between :from_date and :to_date"""
+}
+
+# Libraries the command line entry point must only load once a run needs them
+LAZY_IMPORTS = ['matplotlib', 'seaborn', 'sqlalchemy', 'pkg_resources']
+ENTRY_POINT = 'roundtable_report.__main__'
+IMPORT_CHECK = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))"""
+
+
+def report(datafile, sa_adj, split_col, idx_col, pivot_col, outfile,
+           vis_title=YOY_TITLES, cat_col=None, focus_tbl=0):
+    """
+    Builds the params.json entry of a synthetic report (see
+    docs/json-files.rst for the parameters)
+
+    :returns: dict of parameters used to manipulate the source data
+    """
+    return {
+        'datafile': datafile,
+        'sa_adj': sa_adj,
+        'split_col': split_col,
+        'idx_col': idx_col,
+        'cat_col': [idx_col.title(), cat_col or {}],
+        'reorder_col': '',
+        'pivot_col': pivot_col,
+        'focus_tbl': focus_tbl,
+        'vis_title': vis_title,
+        'outfile': outfile
+    }
+
+
+def synthetic_config(segs=40, media=8):
+    """
+    Builds the data.json, params.json and queries.json contents of the
+    benchmark, covering every split_col/idx_col/pivot_col option
+
+    :param segs: number of bus routes
+    :param media: number of fare media codes
+    :returns: a dict of file contents keyed by filename
+    """
+    hour_bins = {}
+    for hr in range(24):
+        if 3 <= hr < 6:
+            hour_bins[str(hr)] = 'Early Morning'
+        elif 6 <= hr < 9:
+            hour_bins[str(hr)] = 'AM Peak'
+        elif 9 <= hr < 15:
+            hour_bins[str(hr)] = 'Midday'
+        elif 15 <= hr < 18:
+            hour_bins[str(hr)] = 'PM Peak'
+        elif 18 <= hr < 22:
+            hour_bins[str(hr)] = 'Evening'
+        else:
+            hour_bins[str(hr)] = 'Late Night'
+    student_media = list(range(1, media + 1))[:max(1, media // 2)]
+    data = {
+        'hour_bins': hour_bins,
+        'fare_codes': {
+            'finance_code': FINANCE_CODES[:30],
+            'fm_grp': [f"Group {x % 8}" for x in FINANCE_CODES[:30]]},
+        'fare_code_bins': {
+            'finance_code': FINANCE_CODES[:20],
+            'fm_grp_bin': [f"Bin {x % 4}" for x in FINANCE_CODES[:20]]},
+        'student_fare_codes': {
+            'media': student_media,
+            's_fm_grp': [
+                STUDENT_GROUPS[i % len(STUDENT_GROUPS)]
+                for i in range(len(student_media))]},
+        'ventra_fare_codes': {
+            'fare_prod_name': FARE_PRODUCTS[:12],
+            'v_fm_grp': [f"Fare Group {i % 5}" for i in range(12)]},
+        'route_groups': {
+            'rte_group': ROUTE_GROUPS,
+            'r_grp': [f"Route Group {x}" for x in ROUTE_GROUPS]}
+    }
+    params = {
+        'rides-day_type-hr-mo': report(
+            'fare-media-ridership', ['casa', 1000], ['day_type'], 'hr',
+            'Month', 'Mode_Hour-by-Day-Type_YOY'),
+        'rides-sys-s_fm_grp-mo': report(
+            'fare-media-ridership', ['casa', 1], ['sys'], 's_fm_grp', 'Month',
+            'Student-Trends', cat_col={'all': STUDENT_GROUPS + ['Total']}),
+        'rides-all-time_bin-day_type': report(
+            'fare-media-ridership', ['sa', 1], [], 'time_bin', 'day_type',
+            'TimeBin'),
+        'rides-all-fm_grp-mo': report(
+            'fare-media-ridership', ['', 1000], [], 'fm_grp', 'Month', 'FM',
+            focus_tbl=5),
+        'rides-all-fm_grp_bin-mo': report(
+            'fare-media-ridership', ['', 1], [], 'fm_grp_bin', 'Month',
+            'FMBinShare', vis_title={'pct_of_total': 'Share'}),
+        'rides-all-seg-mo': report(
+            'fare-media-ridership', ['', 1], [], 'seg', 'Month', 'Seg'),
+        'rides-day_type-v_fm_grp-mo': report(
+            'ventra-ridership', ['', 1], ['day_type'], 'v_fm_grp', 'Month',
+            'Ventra'),
+        'rides-all-hr-day_type': report(
+            'daily-ridership', ['casa', 1], [], 'hr', 'day_type', 'DailyHr')
+    }
+
+    return {
+        'data.json': data,
+        'params.json': params,
+        'queries.json': QUERIES}
+
+
+def generate_data(rows=10**5, segs=40, media=8, seed=0):
+    """
+    Generates synthetic ridership data over the 25-month query window, plus
+    the system_averages and routes tables
+
+    :param rows: number of rows of each ridership table
+    :param segs: number of bus routes
+    :param media: number of fare media codes
+    :param seed: seed of the random number generator
+    :returns: a dict of pandas dataframes keyed by database table name
+    """
+    rng = np.random.default_rng(seed)
+    window = rrf.params_25M()
+    months = pd.date_range(
+        pd.to_datetime(window['from_date']), pd.to_datetime(window['to_date']),
+        freq='MS')
+    segments = [str(x) for x in range(1, segs + 1)] + RAIL_LINES
+
+    def ridership(columns):
+        table = pd.DataFrame({
+            'type': rng.choice(['bus', 'rail'], rows),
+            'service_date': rng.choice(months.strftime('%Y-%m-%d'), rows),
+            'day_type': rng.choice(['W', 'A', 'U'], rows)})
+        if 'hr' in columns:
+            table['hr'] = rng.integers(0, 24, rows)
+        if 'seg' in columns:
+            table['seg'] = rng.choice(segments, rows)
+        if 'media' in columns:
+            table['media'] = rng.integers(1, media + 1, rows)
+        if 'finance_code' in columns:
+            table['finance_code'] = rng.choice(FINANCE_CODES, rows)
+        if 'fare_prod_name' in columns:
+            table['fare_prod_name'] = rng.choice(FARE_PRODUCTS, rows)
+        table['rides'] = rng.integers(1, 1000, rows).astype(float)
+        return table
+
+    system_averages = pd.DataFrame({
+        'year': months.year,
+        'month': months.month})
+    for col, (low, high) in {
+            'wk': (800, 1000), 'sa': (400, 600), 'su': (300, 400),
+            'cawk': (800, 1000), 'casa': (400, 600),
+            'casu': (300, 400)}.items():
+        system_averages[col] = rng.uniform(low, high, len(months))
+
+    return {
+        'fare_media': ridership(['hr', 'seg', 'media', 'finance_code']),
+        'ventra': ridership(['fare_prod_name']),
+        'daily': ridership(['hr']),
+        'system_averages': system_averages,
+        'routes': pd.DataFrame({
+            'routenum': range(1, segs + 1),
+            'rte_group': [
+                ROUTE_GROUPS[x % len(ROUTE_GROUPS)]
+                for x in range(1, segs + 1)]})
+    }
+
+
+def setup(directory, rows=10**5, segs=40, media=8, seed=0):
+    """
+    Writes the synthetic configuration and SQLite database stand-in of the
+    benchmark, and points the package at them
+
+    :param directory: folder holding the benchmark files
+    :param rows: number of rows of each ridership table
+    :param segs: number of bus routes
+    :param media: number of fare media codes
+    :param seed: seed of the random number generator
+    """
+    config = os.path.join(directory, 'config')
+    os.makedirs(config, exist_ok=True)
+    database = os.path.join(directory, 'bench.db')
+    files = synthetic_config(segs, media)
+    files['secrets.json'] = {
+        'cpc2ds_admin': {'url': f"sqlite:///{os.path.abspath(database)}"}}
+    for name, contents in files.items():
+        with open(os.path.join(config, name), 'w') as outfile:
+            json.dump(contents, outfile, indent=1)
+    os.environ[CONFIG_ENV] = config
+
+    if os.path.exists(database):
+        os.remove(database)
+    with sqlite3.connect(database) as con:
+        for name, table in generate_data(rows, segs, media, seed).items():
+            table.to_sql(name, con, index=False)
+
+
+def import_time(module=ENTRY_POINT, repeat=5):
+    """
+    Times the import of a module in fresh interpreters
+
+    :param module: name of the module
+    :param repeat: number of interpreters to time it in
+    :returns: a (best time in seconds, list of the LAZY_IMPORTS it loaded)
+              tuple
+    """
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_CHECK.format(module=module)],
+            capture_output=True, text=True, check=True).stdout
+        seconds, modules = json.loads(output)
+        best = seconds if best is None else min(best, seconds)
+
+    return best, [x for x in LAZY_IMPORTS if x in modules]
+
+
+def check_imports(module=ENTRY_POINT, repeat=5):
+    """
+    Prints the import time of a module and the LAZY_IMPORTS it loaded
+
+    :param module: name of the module
+    :param repeat: number of interpreters to time it in
+    :returns: a (best time in seconds, list of the LAZY_IMPORTS it loaded)
+              tuple
+    """
+    seconds, eager = import_time(module, repeat)
+    print(f"import {module}: {seconds:.3f}s")
+    for name in eager:
+        print(f"  {name} is imported eagerly")
+
+    return seconds, eager
+
+
+def run(directory, fmt='parquet'):
+    """
+    Times each stage of a report run against the benchmark database
+
+    :param directory: folder holding the benchmark files (see setup)
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
+    :returns: a dict of {stage: {query name or report id: seconds}}
+    """
+    export = os.path.join(directory, 'data')
+    os.makedirs(export, exist_ok=True)
+    # Picks up the configuration written by setup
+    plans = config.load(refresh=True).reports
+    timings = {
+        'import': {}, 'query_data': {}, 'export_data': {}, 'pivot_data': {},
+        'vis_data': {}}
+    timings['import'][ENTRY_POINT] = check_imports()[0]
+
+    for query in sorted(set(plan.datafile for plan in plans.values())):
+        start = time.perf_counter()
+        chunks = list(rrf.query_data(query))
+        timings['query_data'][query] = time.perf_counter() - start
+        start = time.perf_counter()
+        rrf.export_data(iter(chunks), export, query, fmt)
+        timings['export_data'][query] = time.perf_counter() - start
+
+    reference = rrf.ReferenceCache()
+    for id, plan in plans.items():
+        start = time.perf_counter()
+        pivot_tables = rrf.pivot_data(plan, export, reference)
+        timings['pivot_data'][id] = time.perf_counter() - start
+        start = time.perf_counter()
+        failures = rrf.vis_data(plan, export, pivot_tables)
+        timings['vis_data'][id] = time.perf_counter() - start
+        for label, error in failures.items():
+            print(f"Failed to render '{label}': {error}")
+
+    return timings
+
+
+def save_results(directory, results):
+    """
+    Keeps the results of a benchmark run in the 'results' folder
+
+    :param directory: folder holding the benchmark files
+    :param results: dict of run settings and timings
+    :returns: path to the results file
+    """
+    folder = os.path.join(directory, 'results')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(
+        folder, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+
+    return path
+
+
+SETTINGS = ['rows', 'segs', 'media', 'seed', 'format']
+
+
+def load_previous(directory, results, path=None):
+    """
+    Loads the results of the latest benchmark run made with the same settings
+
+    :param directory: folder holding the benchmark files
+    :param results: dict of run settings and timings of the current run
+    :param path: results file to ignore (e.g. the current run's)
+    :returns: dict of run settings and timings (None if there are none)
+    """
+    paths = sorted(
+        glob.glob(os.path.join(directory, 'results', '*.json')), reverse=True)
+    for candidate in paths:
+        if candidate == path:
+            continue
+        with open(candidate, 'r') as infile:
+            previous = json.load(infile)
+        if all(previous.get(x) == results[x] for x in SETTINGS):
+            return previous
+
+    return None
+
+
+def report_results(results, previous=None):
+    """
+    Prints the timings of a benchmark run next to those of a previous run
+
+    :param results: dict of run settings and timings
+    :param previous: dict of run settings and timings (optional)
+    """
+    before = previous['timings'] if previous else {}
+    for stage, timings in results['timings'].items():
+        print(stage)
+        for name, seconds in timings.items():
+            line = f"  {name:<32} {seconds:8.3f}s"
+            if name in before.get(stage, {}):
+                line += f"  (previous {before[stage][name]:.3f}s, " \
+                    f"x{seconds / before[stage][name]:.2f})"
+            print(line)
+        print(f"  {'total':<32} {sum(timings.values()):8.3f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m roundtable_report.benchmark',
+        description="Times a report run against synthetic ridership data in "
+                    "a local SQLite database")
+    parser.add_argument(
+        'directory', help="folder holding the benchmark files and results")
+    parser.add_argument(
+        '--rows', type=int, default=10**5,
+        help="rows of each ridership table (default: 100000)")
+    parser.add_argument(
+        '--segs', type=int, default=40,
+        help="number of bus routes (default: 40)")
+    parser.add_argument(
+        '--media', type=int, default=8,
+        help="number of fare media codes (default: 8)")
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help="seed of the random number generator (default: 0)")
+    parser.add_argument(
+        '--format', dest='fmt', choices=FORMATS,
+        default='parquet', help="datafile format (default: parquet)")
+    parser.add_argument(
+        '--imports', action='store_true',
+        help="only time the import of the command line entry point, failing "
+             "if it loads the plotting or database libraries")
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.imports:
+        # Guards the startup time of every run
+        exit(1 if check_imports()[1] else 0)
+    setup(args.directory, args.rows, args.segs, args.media, args.seed)
+    results = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'rows': args.rows,
+        'segs': args.segs,
+        'media': args.media,
+        'seed': args.seed,
+        'format': args.fmt,
+        'timings': run(args.directory, args.fmt)}
+    path = save_results(args.directory, results)
+    report_results(results, load_previous(args.directory, results, path))
+    print(f"Results saved to {path}")
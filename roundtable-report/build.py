@@ -0,0 +1,193 @@
+from datetime import datetime
+from functools import lru_cache
+import hashlib
+import json
+import os
+
+from roundtable_report import storage
+from roundtable_report.functions import image_path
+
+
+def file_hash(path):
+    """
+    :param path: path to a file
+    :returns: SHA-256 hex digest of the file's contents (None if it doesn't
+              exist)
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+
+    return _file_hash(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, mtime, size):
+    """
+    Hashes a file once per version (modification time and size) of it
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(2**20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def json_hash(value):
+    """
+    :param value: JSON-serializable value
+    :returns: SHA-256 hex digest of the value's canonical JSON text
+    """
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def pivot_hash(pivot_tables):
+    """
+    :param pivot_tables: output of the build_pivots function
+    :returns: SHA-256 hex digest of the labels and contents of the tables
+    """
+    digest = hashlib.sha256()
+    for label in sorted(pivot_tables):
+        digest.update(label.encode())
+        digest.update(pivot_tables[label].to_csv().encode())
+
+    return digest.hexdigest()
+
+
+def table_hash(table):
+    """
+    :param table: pandas dataframe
+    :returns: SHA-256 hex digest of the table's columns and contents
+    """
+    return hashlib.sha256(table.to_csv(index=False).encode()).hexdigest()
+
+
+def report_inputs(directory, plan, data, reference, datafile=True):
+    """
+    Hashes the inputs of a report: its datafile, its params.json entry,
+    data.json and the reference tables it joins, as loaded for the run
+    (from the database or the on-disk copy)
+
+    :param directory: directory containing the datafile
+    :param plan: a ReportPlan
+    :param data: contents of data.json
+    :param reference: ReferenceCache shared across the run
+    :param datafile: whether the report is built from its datafile (False
+                     for streamed and pushed-down runs, whose source data
+                     can't be hashed)
+    :returns: a dict of hex digests
+    """
+    path = None
+    if datafile:
+        try:
+            path = storage.find_datafile(directory, plan.datafile)[0]
+        except FileNotFoundError:
+            pass
+    tables = {'sys_avg': reference.sys_avg, 'r_grp': reference.r_grp}
+
+    return {
+        'datafile': file_hash(path) if path else None,
+        'params': json_hash(plan.params),
+        'data': json_hash(data),
+        'reference': {
+            name: table_hash(tables[name]())
+            for name in sorted(plan.joins) if name in tables}}
+
+
+def load_manifest(directory):
+    """
+    Loads the build manifest of a month directory, which records the inputs,
+    pivot tables and images of each report built in it
+
+    :param directory: report month directory
+    :returns: a dict of {report id: {'inputs', 'pivot', 'images', 'built'}}
+    """
+    path = os.path.join(directory, 'build.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as infile:
+        return json.load(infile)
+
+
+def save_manifest(directory, manifest):
+    """
+    Writes the build manifest of a month directory
+
+    :param directory: report month directory
+    :param manifest: output of the load_manifest function
+    """
+    path = os.path.join(directory, 'build.json')
+    with open(f"{path}.tmp", 'w') as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def outputs_exist(directory, plan, entry):
+    """
+    :param directory: report month directory
+    :param plan: a ReportPlan
+    :param entry: a report's build manifest entry
+    :returns: whether the report's raw_data.csv and images are all on disk
+    """
+    files = [os.path.join(plan.outfile, 'raw_data.csv')] + \
+        entry['images']
+
+    return all(os.path.exists(os.path.join(directory, x)) for x in files)
+
+
+def is_current(manifest, directory, plan, inputs):
+    """
+    Checks whether a report was already built from the same inputs
+
+    :param manifest: output of the load_manifest function
+    :param directory: report month directory
+    :param plan: a ReportPlan
+    :param inputs: output of the report_inputs function
+    :returns: whether the report can be skipped
+    """
+    entry = manifest.get(plan.id)
+
+    return entry is not None and inputs['datafile'] is not None and \
+        entry['inputs'] == inputs and outputs_exist(directory, plan, entry)
+
+
+def is_rendered(manifest, directory, plan, inputs, pivot):
+    """
+    Checks whether a report's images were already rendered from the same
+    pivot tables and parameters
+
+    :param manifest: output of the load_manifest function
+    :param directory: report month directory
+    :param plan: a ReportPlan
+    :param inputs: output of the report_inputs function
+    :param pivot: output of the pivot_hash function
+    :returns: whether rendering the report can be skipped
+    """
+    entry = manifest.get(plan.id)
+
+    return entry is not None and entry['pivot'] == pivot and \
+        entry['inputs']['params'] == inputs['params'] and \
+        outputs_exist(directory, plan, entry)
+
+
+def record(manifest, directory, plan, inputs, pivot, pivot_tables):
+    """
+    Records a built report in the build manifest
+
+    :param manifest: output of the load_manifest function
+    :param directory: report month directory
+    :param plan: a ReportPlan
+    :param inputs: output of the report_inputs function
+    :param pivot: output of the pivot_hash function
+    :param pivot_tables: output of the build_pivots function
+    """
+    manifest[plan.id] = {
+        'inputs': inputs,
+        'pivot': pivot,
+        'images': sorted(
+            os.path.relpath(image_path(plan, directory, label), directory)
+            for label, table in pivot_tables.items()
+            if len(table.index) > 0),
+        'built': datetime.now().isoformat(timespec='seconds')}
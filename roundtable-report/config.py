@@ -0,0 +1,442 @@
+from collections import namedtuple
+import copy
+import json
+import os
+import threading
+
+from roundtable_report.resources import CONFIG_ENV, load_json
+
+# Lookup joins backing the data.json columns: (data.json entry, join key,
+# join type, value of unmatched rows)
+JOINS = {
+    'fm_grp': ('fare_codes', 'finance_code', 'inner', None),
+    'fm_grp_bin': ('fare_code_bins', 'finance_code', 'left', 'Other Rides'),
+    's_fm_grp': ('student_fare_codes', 'media', 'inner', None),
+    'v_fm_grp': ('ventra_fare_codes', 'fare_prod_name', 'inner', None)
+}
+
+# Datafile columns backing each derived split_col/idx_col/pivot_col option
+SOURCE_COLUMNS = {
+    'sys': [],
+    'Month': [],
+    'time_bin': ['hr'],
+    'fm_grp': ['finance_code'],
+    'fm_grp_bin': ['finance_code'],
+    's_fm_grp': ['media'],
+    'v_fm_grp': ['fare_prod_name']
+}
+
+# Column dtypes of the query results, following the queries.json column
+# contract (see docs/json-files.rst); other columns are kept as objects
+COLUMN_DTYPES = {
+    'type': 'object',
+    'service_date': 'datetime64[ns]',
+    'rides': 'float64',
+    'hr': 'int64',
+    'day_type': 'object',
+    'seg': 'object',
+    'media': 'int64',
+    'finance_code': 'int64',
+    'fare_prod_name': 'object'
+}
+
+# Allowed params.json values (see docs/json-files.rst)
+COLUMN_OPTIONS = [
+    'hr', 'time_bin', 'Month', 'day_type', 'fm_grp', 'fm_grp_bin', 's_fm_grp',
+    'v_fm_grp', 'seg']
+SA_ADJ_OPTIONS = ['casa', 'sa', '']
+RESPONSES = ['diff', 'pct_diff', 'pct_of_total']
+MODES = ['bus', 'rail', 'system']
+PARAMS = [
+    'datafile', 'sa_adj', 'split_col', 'idx_col', 'cat_col', 'reorder_col',
+    'pivot_col', 'focus_tbl', 'vis_title', 'outfile']
+CONNECTION_PARTS = ['dbapi', 'username', 'password', 'host', 'port', 'query']
+# Rows fetched per round trip to the database, overridden by the
+# 'arraysize' entry in secrets.json
+ARRAYSIZE = 10**4
+DATABASE = 'cpc2ds_admin'
+
+_configs = {}
+_lock = threading.Lock()
+
+
+class ConfigError(ValueError):
+    """
+    Raised when the JSON files don't follow the layout described in
+    docs/json-files.rst; the message lists every problem found
+    """
+
+
+class Config(namedtuple('Config', [
+        'data', 'params', 'queries', 'secrets', 'reports'])):
+    """
+    Validated contents of the four JSON files, loaded once per run
+
+    :param data: contents of data.json
+    :param params: contents of params.json
+    :param queries: contents of queries.json
+    :param secrets: contents of secrets.json
+    :param reports: dict of ReportPlan objects keyed by report id, in
+                    params.json order
+    """
+    __slots__ = ()
+
+
+class ReportPlan(namedtuple('ReportPlan', [
+        'id', 'params', 'datafile', 'columns', 'group_by', 'joins',
+        'responses', 'months', 'outfile'])):
+    """
+    Compiled form of a params.json entry, built once per run and passed to
+    every stage of the report
+
+    :param id: report id (a key in params.json)
+    :param params: the report's params.json entry; a private copy that no
+                   stage modifies
+    :param datafile: name of the query the report is built from
+    :param columns: datafile columns required to build the report
+    :param group_by: columns the rides column is aggregated by ('sys'
+                     excluded), ending with idx_col and 'service_date'
+    :param joins: names of the lookup tables joined to the source data (see
+                  the ReferenceCache.lookups method)
+    :param responses: responses pivoted (the vis_title keys)
+    :param months: months of the 25-month window the report is built from,
+                   counted back from the report month, or None for the whole
+                   window (see report_months)
+    :param outfile: sub-folder of the month directory the report is written
+                    to
+    """
+    __slots__ = ()
+
+    def path(self, directory):
+        """
+        :param directory: report month directory
+        :returns: path of the folder holding the report's outputs
+        """
+        return os.path.join(directory, self.outfile)
+
+
+def report_columns(params):
+    """
+    Lists the datafile columns required to build a report
+
+    :param params: dict of parameters used to manipulate the source data
+    :returns: a list of column names
+    """
+    columns = ['type', 'service_date', 'rides']
+    if params['sa_adj'][0]:
+        columns.append('day_type')
+    for col in params['split_col'] + [params['idx_col'], params['pivot_col']]:
+        for source_col in SOURCE_COLUMNS.get(col, [col]):
+            if source_col not in columns:
+                columns.append(source_col)
+
+    return columns
+
+
+def report_group_by(params):
+    """
+    Lists the columns a report aggregates the rides column by
+
+    :param params: dict of parameters used to manipulate the source data
+    :returns: a list of column names ('sys' excluded) ending with idx_col and
+              'service_date'
+    """
+    group_by = ['type'] + \
+        [col for col in params['split_col'] if col != 'sys'] + \
+        [params['idx_col'], 'service_date']
+    if params['pivot_col'] != 'Month':
+        group_by.insert(-2, params['pivot_col'])
+
+    return group_by
+
+
+def report_joins(params):
+    """
+    Lists the lookup tables joined to the source data of a report
+
+    :param params: dict of parameters used to manipulate the source data
+    :returns: a list of data.json entry names, plus 'hour_bins', 'sys_avg'
+              and 'r_grp' when needed
+    """
+    group_by = report_group_by(params)
+    joins = []
+    if 'time_bin' in group_by:
+        joins.append('hour_bins')
+    for col, (name, key, how, fill) in JOINS.items():
+        if col in group_by:
+            joins.append(name)
+    if params['sa_adj'][0]:
+        joins.append('sys_avg')
+    if 'seg' in group_by:
+        joins.append('r_grp')
+
+    return joins
+
+
+def report_months(params):
+    """
+    Lists the months of the 25-month window a report is built from
+
+    :param params: dict of parameters used to manipulate the source data
+    :returns: a tuple of month offsets counted back from the report month (0
+              for the report month, 12 for the same month a year earlier),
+              or None if the report needs the whole window
+    """
+    if params['pivot_col'] != 'Month':
+        # Only the report month is pivoted, against the same month a year
+        # earlier
+        return (0, 12)
+    if 'pct_of_total' in params['vis_title']:
+        # Shares of the last 13 months
+        return tuple(range(13))
+    # Year-over-year responses of the last 13 months, each looking back 12
+    # months
+    return None
+
+
+def compile_plan(id, params):
+    """
+    :param id: report id (a key in params.json)
+    :param params: a validated params.json entry
+    :returns: a ReportPlan
+    """
+    params = copy.deepcopy(params)
+
+    return ReportPlan(
+        id=id,
+        params=params,
+        datafile=params['datafile'],
+        columns=tuple(report_columns(params)),
+        group_by=tuple(report_group_by(params)),
+        joins=tuple(report_joins(params)),
+        responses=tuple(params['vis_title']),
+        months=report_months(params),
+        outfile=params['outfile'])
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_orders(value):
+    """
+    Checks a cat_col or reorder_col ordering dictionary
+
+    :param value: dict of lists keyed by mode ('all' or anything if there is
+                  only one)
+    :returns: a list of problems
+    """
+    if not isinstance(value, dict):
+        return ["must be a dictionary"]
+    problems = []
+    if any(not isinstance(x, list) for x in value.values()):
+        problems.append("must map to lists of values")
+    if len(value) > 1 and any(x not in MODES for x in value):
+        problems.append(
+            f"keys must be modes ({', '.join(MODES)}) when there is more "
+            f"than one")
+
+    return problems
+
+
+def validate_report(params, data, queries):
+    """
+    Checks a params.json entry against docs/json-files.rst
+
+    :param params: a params.json entry
+    :param data: contents of data.json
+    :param queries: contents of queries.json
+    :returns: a list of problems
+    """
+    if not isinstance(params, dict):
+        return ["must be a dictionary"]
+    missing = [x for x in PARAMS if x not in params]
+    if missing:
+        return [f"missing {', '.join(missing)}"]
+    problems = []
+    if params['datafile'] not in queries:
+        problems.append(
+            f"datafile '{params['datafile']}' isn't a query in queries.json")
+    sa_adj = params['sa_adj']
+    if not isinstance(sa_adj, list) or len(sa_adj) != 2 or \
+            sa_adj[0] not in SA_ADJ_OPTIONS or not is_number(sa_adj[1]) or \
+            sa_adj[1] == 0:
+        problems.append(
+            f"sa_adj must be [one of {SA_ADJ_OPTIONS}, a non-zero number]")
+    if not isinstance(params['split_col'], list):
+        problems.append("split_col must be a list")
+    else:
+        for col in params['split_col']:
+            if col not in COLUMN_OPTIONS + ['sys'] or col == 'Month':
+                problems.append(f"unknown split_col '{col}'")
+    if params['idx_col'] not in COLUMN_OPTIONS or \
+            params['idx_col'] == 'Month':
+        problems.append(f"unknown idx_col '{params['idx_col']}'")
+    if params['pivot_col'] not in COLUMN_OPTIONS:
+        problems.append(f"unknown pivot_col '{params['pivot_col']}'")
+    elif params['pivot_col'] == params['idx_col']:
+        problems.append("idx_col and pivot_col must differ")
+    cat_col = params['cat_col']
+    if not isinstance(cat_col, list) or len(cat_col) != 2 or \
+            not isinstance(cat_col[0], str):
+        problems.append("cat_col must be [column name, ordering dictionary]")
+    else:
+        problems += [f"cat_col {x}" for x in validate_orders(cat_col[1])]
+    if params['reorder_col']:
+        problems += [
+            f"reorder_col {x}" for x in validate_orders(params['reorder_col'])]
+    focus_tbl = params['focus_tbl']
+    if not isinstance(focus_tbl, int) or isinstance(focus_tbl, bool) or \
+            not 0 <= focus_tbl <= 9:
+        problems.append("focus_tbl must be an integer from 0 to 9")
+    vis_title = params['vis_title']
+    if not isinstance(vis_title, dict) or not vis_title:
+        problems.append("vis_title must be a non-empty dictionary")
+    else:
+        for val in vis_title:
+            if val not in RESPONSES:
+                problems.append(f"unknown vis_title response '{val}'")
+        if 'pct_of_total' in vis_title and len(vis_title) > 1:
+            problems.append(
+                "vis_title can't combine 'pct_of_total' with other responses")
+    if not isinstance(params['outfile'], str) or not params['outfile']:
+        problems.append("outfile must be a non-empty string")
+    if problems:
+        return problems
+
+    # The data.json entries joined to the source data
+    entries = {}
+    for name in report_joins(params):
+        if name == 'r_grp':
+            entries['route_groups'] = ['rte_group', 'r_grp']
+        elif name == 'hour_bins':
+            entries[name] = []
+        elif name != 'sys_avg':
+            col = next(x for x, join in JOINS.items() if join[0] == name)
+            entries[name] = [JOINS[col][1], col]
+    for entry, columns in entries.items():
+        if entry not in data:
+            problems.append(f"needs the '{entry}' entry of data.json")
+        elif any(x not in data[entry] for x in columns):
+            problems.append(
+                f"needs the {', '.join(columns)} columns of the '{entry}' "
+                f"entry of data.json")
+
+    return problems
+
+
+def validate_data(data):
+    """
+    Checks data.json against docs/json-files.rst
+
+    :param data: contents of data.json
+    :returns: a list of problems
+    """
+    if not isinstance(data, dict):
+        return ["data.json must be a dictionary"]
+    problems = []
+    for entry, value in data.items():
+        if not isinstance(value, dict):
+            problems.append(f"data.json: '{entry}' must be a dictionary")
+        elif entry == 'hour_bins':
+            if any(not x.isdigit() for x in value):
+                problems.append(
+                    "data.json: 'hour_bins' keys must be hours (0-23)")
+        elif any(not isinstance(x, list) for x in value.values()) or \
+                len(set(len(x) for x in value.values())) > 1:
+            problems.append(
+                f"data.json: '{entry}' must map to lists of equal length")
+
+    return problems
+
+
+def validate_secrets(secrets):
+    """
+    Checks secrets.json against docs/json-files.rst
+
+    :param secrets: contents of secrets.json
+    :returns: a list of problems
+    """
+    if not isinstance(secrets, dict):
+        return ["secrets.json must be a dictionary"]
+    problems = []
+    if DATABASE not in secrets:
+        problems.append(f"secrets.json: missing the '{DATABASE}' entry")
+    for name, engine in secrets.items():
+        if not isinstance(engine, dict):
+            problems.append(f"secrets.json: '{name}' must be a dictionary")
+            continue
+        missing = [x for x in CONNECTION_PARTS if x not in engine]
+        if not engine.get('url') and missing:
+            problems.append(
+                f"secrets.json: '{name}' needs a url or "
+                f"{', '.join(missing)}")
+        if not isinstance(engine.get('pool', {}), dict):
+            problems.append(
+                f"secrets.json: '{name}' pool must be a dictionary")
+        arraysize = engine.get('arraysize', ARRAYSIZE)
+        if not isinstance(arraysize, int) or isinstance(arraysize, bool) or \
+                arraysize < 1:
+            problems.append(
+                f"secrets.json: '{name}' arraysize must be a positive "
+                f"integer")
+
+    return problems
+
+
+def compile_config(data, params, queries, secrets):
+    """
+    Validates the contents of the four JSON files and compiles every report
+
+    :param data: contents of data.json
+    :param params: contents of params.json
+    :param queries: contents of queries.json
+    :param secrets: contents of secrets.json
+    :returns: a Config
+    :raises ConfigError: listing every problem found
+    """
+    problems = validate_data(data) + validate_secrets(secrets)
+    if not isinstance(queries, dict) or any(
+            not isinstance(x, str) for x in queries.values()):
+        problems.append("queries.json must map query names to SQL text")
+        queries = {}
+    if not isinstance(params, dict):
+        problems.append("params.json must be a dictionary")
+        params = {}
+    for id, report in params.items():
+        problems += [
+            f"params.json: '{id}' {x}"
+            for x in validate_report(report, data, queries)]
+    if problems:
+        raise ConfigError(
+            "Invalid configuration:\n  " + "\n  ".join(problems))
+
+    return Config(
+        data=data,
+        params=params,
+        queries=queries,
+        secrets=secrets,
+        reports={
+            id: compile_plan(id, report) for id, report in params.items()})
+
+
+def load(refresh=False):
+    """
+    Returns the process-wide configuration, loading and validating the JSON
+    files on first use (once per CONFIG_ENV folder)
+
+    :param refresh: load the JSON files again, e.g. after they were edited
+    :returns: a Config
+    :raises ConfigError: if a file is missing, malformed or invalid
+    """
+    key = os.environ.get(CONFIG_ENV) or None
+    with _lock:
+        if refresh or key not in _configs:
+            files = {}
+            for name in ['data', 'params', 'queries', 'secrets']:
+                try:
+                    files[name] = load_json(f"{name}.json")
+                except (OSError, json.JSONDecodeError) as e:
+                    raise ConfigError(f"Can't load {name}.json: {e}")
+            _configs[key] = compile_config(**files)
+    return _configs[key]
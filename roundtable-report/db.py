@@ -0,0 +1,90 @@
+import threading
+
+import sqlalchemy as sa
+
+from roundtable_report import config
+
+# Connection pool settings, overridden by the 'pool' entry in secrets.json
+POOL_DEFAULTS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 3600
+}
+
+_engines = {}
+_lock = threading.Lock()
+
+
+def engine_url(engine):
+    """
+    Builds the database URL of a secrets.json entry
+
+    :param engine: dict of connection parameters; either a full 'url' (e.g.
+                   a SQLite stand-in) or the 'dbapi', 'username', 'password',
+                   'host', 'port' and 'query' entries
+    :returns: a SQLAlchemy URL
+    """
+    if engine.get('url'):
+        return sa.engine.url.make_url(engine['url'])
+    create = getattr(sa.engine.url.URL, 'create', sa.engine.url.URL)
+
+    return create(
+        engine['dbapi'],
+        username=engine['username'],
+        password=engine['password'],
+        host=engine['host'],
+        port=engine['port'],
+        query=engine['query'])
+
+
+def get_engine(name='cpc2ds_admin'):
+    """
+    Returns the process-wide engine of a secrets.json entry, creating it (and
+    its connection pool) on first use
+
+    :param name: key of the connection parameters in secrets.json
+    :returns: a SQLAlchemy engine
+    """
+    with _lock:
+        if name not in _engines:
+            engine = config.load().secrets[name]
+            url = engine_url(engine)
+            options = dict(POOL_DEFAULTS, **engine.get('pool', {}))
+            if url.get_backend_name() == 'sqlite':
+                # SQLite pools are not sized
+                options.pop('pool_size')
+                options.pop('max_overflow')
+            _engines[name] = sa.create_engine(url, **options)
+            if url.get_backend_name() == 'sqlite':
+                sa.event.listen(_engines[name], 'connect', _sqlite_functions)
+    return _engines[name]
+
+
+def _sqlite_functions(dbapi_connection, connection_record):
+    """
+    Registers the Oracle functions used by the package's queries on a SQLite
+    stand-in connection
+    """
+    dbapi_connection.create_function('to_char', 1, str)
+
+
+def connect(name='cpc2ds_admin'):
+    """
+    Checks a connection out of the shared pool
+
+    :param name: key of the connection parameters in secrets.json
+    :returns: a SQLAlchemy connection (usable as a context manager)
+    """
+    return get_engine(name).connect()
+
+
+def dispose():
+    """
+    Closes every pooled connection and forgets the engines, e.g. after a fork
+    or a change to secrets.json (reloaded with config.load(refresh=True))
+    """
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
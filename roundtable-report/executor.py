@@ -0,0 +1,301 @@
+from concurrent.futures import (
+    CancelledError, ThreadPoolExecutor, as_completed)
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from itertools import chain
+import os
+import queue
+import shutil
+import threading
+
+from roundtable_report import functions as rrf
+from roundtable_report import storage
+from roundtable_report.instrument import print_log
+
+# Format of the intermediate shard files; Arrow IPC keeps the dtypes and is
+# the cheapest to write and read back
+SHARD_FORMAT = 'arrow'
+
+
+def month_shards(params):
+    """
+    Splits a query window into calendar month windows
+
+    :param params: dict with 'from_date' and 'to_date' entries formatted as
+                   '%Y%m%d' (see params_25M)
+    :returns: a list of dicts of the same form, one per month, in order
+    """
+    start = datetime.strptime(params['from_date'], '%Y%m%d')
+    end = datetime.strptime(params['to_date'], '%Y%m%d')
+    shards = []
+    while start <= end:
+        shard_end = min(
+            start + relativedelta(day=1, months=1, days=-1), end)
+        shards.append({'from_date': start.strftime('%Y%m%d'),
+                       'to_date': shard_end.strftime('%Y%m%d')})
+        start = shard_end + relativedelta(days=1)
+
+    return shards
+
+
+def shard_directory(directory, query):
+    """
+    :param directory: destination directory of the datafile
+    :param query: name of the query
+    :returns: path of the folder holding a query's intermediate shard files
+    """
+    return os.path.join(directory, '.shards', query)
+
+
+def fetch_shard(query, shard, directory, name=None,
+                chunksize=storage.CHUNKSIZE, stop=None):
+    """
+    Runs a query over one shard window and writes the result to an
+    intermediate shard file, writing each chunk on a writer thread while the
+    next one is fetched
+
+    :param query: name of the query (a key in queries.json)
+    :param shard: one of the outputs of the month_shards function
+    :param directory: folder to write the shard file to
+    :param name: name of the shard file (optional, defaults to the shard's
+                 from_date)
+    :param chunksize: number of rows fetched per chunk
+    :param stop: threading.Event telling the fetch to give up after the
+                 current chunk (optional)
+    :returns: number of rows written
+    :raises CancelledError: if stop was set before the shard was fetched
+    """
+    rows = 0
+
+    def count(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            if stop is not None and stop.is_set():
+                raise CancelledError(f"{query} shard {shard['from_date']}")
+            rows += len(chunk)
+            yield chunk
+
+    os.makedirs(directory, exist_ok=True)
+    storage.write_chunks(
+        count(rrf.query_data(query, shard, chunksize)), directory,
+        name or shard['from_date'], SHARD_FORMAT, storage.WRITE_BUFFER)
+
+    return rows
+
+
+def concat_shards(query, names, shards, directory, fmt='parquet'):
+    """
+    Concatenates shard files, in order, into a query's datafile
+
+    :param query: name of the query (and filename to export)
+    :param names: list of shard file names, in order
+    :param shards: folder holding the shard files
+    :param directory: destination directory to export data to
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
+    """
+    # Shards without any rows don't produce a file
+    names = [
+        name for name in names
+        if os.path.exists(storage.datafile_path(shards, name, SHARD_FORMAT))]
+    storage.write_chunks(
+        chain.from_iterable(
+            storage.read_chunks(shards, name, fmt=SHARD_FORMAT)
+            for name in names),
+        directory, query, fmt)
+
+
+def stitch_shards(query, names, directory, fmt='parquet'):
+    """
+    Concatenates a query's intermediate shard files, in order, into its
+    datafile and removes them
+
+    :param query: name of the query (and filename to export)
+    :param names: list of shard file names, in order
+    :param directory: destination directory to export data to
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
+    """
+    shards = shard_directory(directory, query)
+    concat_shards(query, names, shards, directory, fmt)
+    shutil.rmtree(shards)
+    if not os.listdir(os.path.dirname(shards)):
+        os.rmdir(os.path.dirname(shards))
+
+
+def run_queries(queries, directory, fmt='parquet', workers=4, params=None,
+                chunksize=storage.CHUNKSIZE, stop=None):
+    """
+    Runs every query split into month shards on a bounded pool of worker
+    threads, and stitches each query's shards into its datafile once they
+    have all been fetched
+
+    Each worker checks its own connection out of the shared engine pool, so
+    workers should not exceed the pool's size plus overflow.
+
+    :param queries: list of query names (keys in queries.json)
+    :param directory: destination directory to export data to
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
+    :param workers: maximum number of shards fetched at once
+    :param params: query window (optional, defaults to params_25M)
+    :param chunksize: number of rows fetched per chunk
+    :param stop: threading.Event telling the running shards to give up after
+                 their current chunk and the others not to start (optional)
+    :returns: an iterator of query names, yielded as each datafile is created
+    """
+    shards = month_shards(params or rrf.params_25M())
+    names = [shard['from_date'] for shard in shards]
+    pending = {query: len(shards) for query in queries}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                fetch_shard, query, shard,
+                shard_directory(directory, query),
+                chunksize=chunksize, stop=stop): query
+            for query in queries
+            for shard in shards}
+        try:
+            for future in as_completed(futures):
+                if stop is not None and stop.is_set():
+                    break
+                query = futures[future]
+                if future.exception() is not None:
+                    raise future.exception()
+                pending[query] -= 1
+                if pending[query] == 0:
+                    stitch_shards(query, names, directory, fmt)
+                    yield query
+        finally:
+            # Don't start the remaining shards if one of them failed or the
+            # consumer stopped early
+            for future in futures:
+                future.cancel()
+
+
+def stream_query(query, workers=4, params=None, windows=None,
+                 chunksize=storage.CHUNKSIZE):
+    """
+    Runs a query split into month shards on a bounded pool of worker threads
+    and yields the fetched chunks as they arrive, without writing them to
+    disk
+
+    Chunks are yielded in arrival order rather than date order. At most
+    twice as many chunks as workers are held in memory at once.
+
+    :param query: name of the query (a key in queries.json)
+    :param workers: maximum number of shards fetched at once
+    :param params: query window (optional, defaults to params_25M)
+    :param windows: list of query windows within params to fetch instead of
+                    the whole of it (optional, see functions.scan_windows)
+    :param chunksize: number of rows fetched per chunk
+    :returns: an iterator of pandas dataframes
+    """
+    shards = [
+        shard for window in windows or [params or rrf.params_25M()]
+        for shard in month_shards(window)]
+    chunks = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer is gone, so that a full queue never
+        # blocks a worker for good
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(shard):
+        # Ends with a (shard, error) tuple telling the consumer the shard is
+        # done
+        error = None
+        try:
+            for chunk in rrf.query_data(query, shard, chunksize):
+                if not put(chunk):
+                    break
+        except Exception as e:
+            error = e
+        put((shard['from_date'], error))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch, shard) for shard in shards]
+        try:
+            done = 0
+            while done < len(futures):
+                item = chunks.get()
+                if isinstance(item, tuple):
+                    done += 1
+                    if item[1] is not None:
+                        raise item[1]
+                else:
+                    yield item
+        finally:
+            # Stop the workers if the consumer stopped early or a shard
+            # failed, unblocking any of them waiting on a full queue
+            stop.set()
+            for future in futures:
+                future.cancel()
+            while not all(future.done() for future in futures):
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+def background(iterator, stop=None):
+    """
+    Runs an iterator on a background thread, so that it keeps producing
+    items (e.g. the datafiles of run_queries) while the caller processes the
+    ones already produced
+
+    An exception raised by the iterator is raised again by the caller. If
+    the caller stops early, stop is set and the iterator is closed once it
+    produces its next item; the thread is joined, and an error it raises
+    meanwhile is logged.
+
+    :param iterator: iterator (or generator) of items
+    :param stop: threading.Event the iterator checks to give up early
+                 (optional, e.g. the stop argument of run_queries)
+    :returns: an iterator of the same items, yielded as they are produced
+    """
+    items = queue.Queue()
+    stop = stop or threading.Event()
+    end = object()
+
+    def run():
+        # Ends with an (end, error) tuple telling the consumer the iterator
+        # is exhausted
+        error = None
+        try:
+            for item in iterator:
+                items.put((item, None))
+                if stop.is_set():
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        items.put((end, error))
+
+    thread = threading.Thread(target=run, name='background')
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        # The caller is no longer reading, so an error raised since can only
+        # be logged
+        while not items.empty():
+            item, error = items.get()
+            if error is not None and \
+                    not isinstance(error, CancelledError):
+                print_log(f"Background run failed after the caller stopped: "
+                          f"{type(error).__name__}: {error}")
@@ -0,0 +1,129 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from roundtable_report import config
+from roundtable_report.db import get_engine
+
+
+def compile_query(text, params, dialect):
+    """
+    Compiles a query's text and bound parameters for a DBAPI cursor
+
+    :param text: SQL text with named bound parameters (e.g. ':from_date')
+    :param params: dict of the bound parameters' values
+    :param dialect: SQLAlchemy dialect of the database
+    :returns: a (statement, parameters) tuple in the DBAPI's paramstyle
+    """
+    compiled = sa.text(text).compile(dialect=dialect)
+    binds = compiled.construct_params(params)
+    if compiled.positional:
+        binds = [binds[name] for name in compiled.positiontup]
+
+    return str(compiled), binds
+
+
+def open_cursor(connection, dialect, arraysize):
+    """
+    Opens a DBAPI cursor that streams the rows from the database server
+
+    Oracle cursors always do; psycopg2 only does for named cursors.
+
+    :param connection: DBAPI connection (e.g. from Engine.raw_connection)
+    :param dialect: SQLAlchemy dialect of the database
+    :param arraysize: number of rows fetched per round trip
+    :returns: a DBAPI cursor
+    """
+    if dialect.driver == 'psycopg2':
+        cursor = connection.cursor(name=f"roundtable_{uuid.uuid4().hex}")
+        cursor.itersize = arraysize
+    else:
+        cursor = connection.cursor()
+    cursor.arraysize = arraysize
+
+    return cursor
+
+
+def fill(buffer, start, values):
+    """
+    Copies a column of fetched values into a buffer, widening the buffer if
+    a value doesn't fit its dtype (e.g. a null in an integer column)
+
+    :param buffer: numpy array
+    :param start: position of the first value in the buffer
+    :param values: tuple of values
+    :returns: the buffer, or the widened copy of it
+    """
+    try:
+        buffer[start:start + len(values)] = values
+    except (TypeError, ValueError):
+        # Integers widen to floats (nulls become NaN), anything else to
+        # objects
+        return fill(
+            buffer.astype(np.float64 if buffer.dtype.kind in 'iu' else object),
+            start, values)
+
+    return buffer
+
+
+def fetch_chunks(text, params, chunksize, name=config.DATABASE):
+    """
+    Runs a query and yields its results as dataframes of typed columns
+
+    The rows are fetched with DBAPI fetchmany calls on a single streaming
+    cursor and copied, a column at a time, into NumPy buffers preallocated
+    with the dtypes of the queries.json column contract (see
+    config.COLUMN_DTYPES), so that no intermediate dataframe of Python
+    objects is built. A column widens, for this and every later chunk, when
+    a value doesn't fit its dtype. Like pandas.read_sql, yields a single
+    empty dataframe if the query returns no rows.
+
+    :param text: SQL text of the query (a value in queries.json)
+    :param params: dict of the query's bound parameters
+    :param chunksize: number of rows per dataframe
+    :param name: key of the connection parameters in secrets.json
+    :returns: an iterator of pandas dataframes
+    """
+    engine = get_engine(name)
+    dialect = engine.dialect
+    arraysize = config.load().secrets[name].get(
+        'arraysize', config.ARRAYSIZE)
+    statement, binds = compile_query(text, params, dialect)
+    connection = engine.raw_connection()
+    try:
+        cursor = open_cursor(connection, dialect, arraysize)
+        try:
+            cursor.execute(statement, binds)
+            names = [
+                dialect.normalize_name(column[0])
+                if dialect.requires_name_normalize else column[0]
+                for column in cursor.description]
+            dtypes = [
+                config.COLUMN_DTYPES.get(column, 'object')
+                for column in names]
+            chunks = 0
+            while True:
+                buffers = [np.empty(chunksize, dtype) for dtype in dtypes]
+                rows = 0
+                while rows < chunksize:
+                    batch = cursor.fetchmany(min(arraysize, chunksize - rows))
+                    if not batch:
+                        break
+                    for i, values in enumerate(zip(*batch)):
+                        buffers[i] = fill(buffers[i], rows, values)
+                    rows += len(batch)
+                if rows == 0 and chunks > 0:
+                    break
+                dtypes = [buffer.dtype for buffer in buffers]
+                yield pd.DataFrame({
+                    column: buffer[:rows]
+                    for column, buffer in zip(names, buffers)})
+                chunks += 1
+                if rows < chunksize:
+                    break
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
@@ -1,261 +1,442 @@
+from concurrent.futures import as_completed
 from datetime import date, time, datetime
 from dateutil.relativedelta import relativedelta
-import json
 import os
-import pkg_resources
 from textwrap import fill
 
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fnt
 import pandas as pd
-import seaborn as sns
-import sqlalchemy as sa
 
+from roundtable_report import config
+from roundtable_report import responses
+from roundtable_report import storage
+from roundtable_report.accumulate import Accumulator
+from roundtable_report.config import JOINS
+from roundtable_report.reference import ReferenceCache
 
-def params_25M():
+
+def report_month(today=None):
+    """
+    :param today: date of the run (optional, defaults to today)
+    :returns: datetime of the first day of the month before today's, the
+              month the reports are built for
+    """
+    today = today or date.today()
+
+    return datetime.combine(today, time.min) - \
+        relativedelta(day=1, months=1)
+
+
+def params_25M(month=None):
     """
     Creates a dictionary with start and end dates corresponding to the
     25-month range used in most queries
 
+    :param month: datetime of the first day of the report month (optional,
+                  defaults to the output of report_month)
     :returns: a dict ready for use in a SQLAlchemy connection
     """
-    prev_month_end = datetime.combine(date.today(), time.min) - \
-        relativedelta(days=datetime.now().day - 1) - \
-        relativedelta(days=1)
-    prev_month_25m = prev_month_end + relativedelta(days=1) - \
-        relativedelta(months=25)
+    month = month or report_month()
+    prev_month_end = month + relativedelta(months=1, days=-1)
+    prev_month_25m = month - relativedelta(months=24)
     parameters = {'from_date': prev_month_25m.strftime('%Y%m%d'),
                   'to_date': prev_month_end.strftime('%Y%m%d')}
 
     return parameters
 
 
-def query_data(query):
-    """
-    Opens a connection to the 'cpc2ds_admin' database, then executes each
-    query.
-
-    :returns: an iterator for the chunked data
-    """
-    queryfile = pkg_resources.resource_filename(
-        'roundtable_report', 'queries.json')
-    secretsfile = pkg_resources.resource_filename(
-        'roundtable_report', 'secrets.json')
-    with open(queryfile, 'r') as infile:
-        queries = json.load(infile)
-    with open(secretsfile, 'r') as infile:
-        secrets = json.load(infile)
-    engine = secrets['cpc2ds_admin']
-    ora = sa.create_engine(sa.engine.url.URL(
-        engine['dbapi'],
-        username=engine['username'],
-        password=engine['password'],
-        host=engine['host'],
-        port=engine['port'],
-        query=engine['query']))
-    params = params_25M()
-    table = pd.read_sql(
-        sa.text(queries[query]), ora, params=params, chunksize=(5 * 10**5))
+def backfill_params(months):
+    """
+    Creates a dictionary with start and end dates spanning the 25-month
+    ranges of several report months
 
-    return table
+    :param months: list of datetimes of the first day of the report months
+    :returns: a dict of the same form as the output of params_25M
+    """
+    return {'from_date': params_25M(min(months))['from_date'],
+            'to_date': params_25M(max(months))['to_date']}
+
+
+def report_windows(months, params=None):
+    """
+    Converts the months a report is built from into query windows
+
+    :param months: iterable of month offsets counted back from the report
+                   month (see ReportPlan.months), or None for the whole
+                   window
+    :param params: query window (optional, defaults to params_25M)
+    :returns: a list of dicts of the same form as params, one per run of
+              consecutive months, in order
+    """
+    params = params or params_25M()
+    if months is None:
+        return [dict(params)]
+    start = datetime.strptime(params['from_date'], '%Y%m%d')
+    end = datetime.strptime(params['to_date'], '%Y%m%d')
+    windows = []
+    for offset in sorted(set(months), reverse=True):
+        month_start = end - relativedelta(day=1, months=offset)
+        month_end = month_start + relativedelta(months=1, days=-1)
+        month_start, month_end = max(month_start, start), min(month_end, end)
+        if month_start > month_end:
+            continue
+        if windows and windows[-1][1] + relativedelta(days=1) == month_start:
+            windows[-1][1] = month_end
+        else:
+            windows.append([month_start, month_end])
+
+    return [
+        {'from_date': window_start.strftime('%Y%m%d'),
+         'to_date': window_end.strftime('%Y%m%d')}
+        for window_start, window_end in windows]
 
 
-def export_data(table, directory, query):
+def scan_windows(reports, months=None):
+    """
+    Lists the query windows a scan of the reports built from the same query
+    needs
+
+    :param reports: dict of ReportPlan objects keyed by report id
+    :param months: list of datetimes of the first day of the report months
+                   (optional, defaults to the output of report_month)
+    :returns: the output of the report_windows function for the months of
+              every report, merged across the report months, or None if one
+              of the reports needs the whole window
+    """
+    offsets = set()
+    for plan in reports.values():
+        if plan.months is None:
+            if months is None or len(months) == 1:
+                return None
+            offsets = None
+            break
+        offsets.update(plan.months)
+
+    # Merge the windows of every report month, joining the ones that
+    # overlap or follow each other
+    windows = []
+    for window in sorted(
+            (window for month in months or [None]
+             for window in report_windows(offsets, params_25M(month))),
+            key=lambda x: x['from_date']):
+        start = datetime.strptime(window['from_date'], '%Y%m%d')
+        if windows and start <= datetime.strptime(
+                windows[-1]['to_date'], '%Y%m%d') + relativedelta(days=1):
+            windows[-1]['to_date'] = max(
+                windows[-1]['to_date'], window['to_date'])
+        else:
+            windows.append(dict(window))
+
+    return windows
+
+
+def query_data(query, params=None, chunksize=storage.CHUNKSIZE):
+    """
+    Executes a query against the 'cpc2ds_admin' database using the shared
+    engine's connection pool
+
+    :param query: name of the query (a key in queries.json)
+    :param params: dict with 'from_date' and 'to_date' entries (optional,
+                   defaults to the output of params_25M)
+    :param chunksize: number of rows fetched per chunk
+    :returns: an iterator of pandas dataframes with the dtypes of the
+              queries.json column contract (see fetch.fetch_chunks)
+    """
+    # Imported here so only the runs that query the database load SQLAlchemy
+    from roundtable_report import fetch
+
+    if params is None:
+        params = params_25M()
+
+    return fetch.fetch_chunks(
+        config.load().queries[query], params, chunksize)
+
+
+def export_data(table, directory, query, fmt='parquet'):
     """
     Takes the iterator returned from the query_data function and exports the
-    merged chunks to a .csv file
+    merged chunks to a local datafile, writing each chunk on a writer thread
+    while the next one is fetched
 
     :param table: output of the query_data function (iterator)
     :param directory: destination directory to export data to
     :param query: name of query (and filename to export)
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
     """
-    flag = 0
-    for chunk in table:
-        if flag == 0:
-            chunk.to_csv(f"{directory}/{query}.csv")
-            flag = 1
-        else:
-            with open(f"{directory}/{query}.csv", 'a') as file:
-                chunk.to_csv(file, header=False)
-
-
-def import_sys_avg():
-    """
-    Imports the system_averages table into a pandas dataframe and transforms
-    the results for use with the main aggregation table
-
-    :returns: pandas dataframe of transformed query results
-    """
-    # Perform query
-    query = """
-    select year, month, wk, sa, su, cawk, casa, casu
-    from system_averages"""
-    secretsfile = pkg_resources.resource_filename(
-        'roundtable_report', 'secrets.json')
-    with open(secretsfile, 'r') as infile:
-        secrets = json.load(infile)
-    engine = secrets['cpc2ds_admin']
-    ora = sa.create_engine(sa.engine.url.URL(
-        engine['dbapi'],
-        username=engine['username'],
-        password=engine['password'],
-        host=engine['host'],
-        port=engine['port'],
-        query=engine['query']))
-    system_averages = pd.read_sql(sa.text(query), ora)
-
-    # Melt system average and calendar-adjusted system average columns
-    sys_avg = pd.melt(system_averages,
-                      id_vars=['year', 'month'],
-                      value_vars=['wk', 'sa', 'su'],
-                      var_name='daytype',
-                      value_name='sa')
-    cal_sys_avg = pd.melt(system_averages,
-                          id_vars=['year', 'month'],
-                          value_vars=['cawk', 'casa', 'casu'],
-                          var_name='daytype',
-                          value_name='casa')
-
-    # Merge melted columns and format date and day_type columns to merge with
-    # the main aggregation table
-    cal_sys_avg.daytype = cal_sys_avg.daytype.apply(lambda x: x[2:])
-    system_averages = pd.merge(
-        sys_avg, cal_sys_avg, on=['year', 'month', 'daytype'])
-    system_averages['day_type'] = system_averages.daytype.apply(
-        lambda x: 'W' if x == 'wk' else x[-1].upper())
-    system_averages['service_date'] = pd.to_datetime(
-        (system_averages.year.astype(str) +
-         system_averages.month.astype(str).str.zfill(2)),
-        format="%Y%m")
-
-    return system_averages
-
-
-def import_r_grp():
-    """
-    Imports bus route information into a pandas dataframe and merges the
-    relevant dict containing the new row names
-
-    :returns: pandas dataframe of modified query results
-    """
-    datafile = pkg_resources.resource_filename(
-        'roundtable_report', 'data.json')
-    with open(datafile, 'r') as infile:
-        data = json.load(infile)
-    query = """
-    select to_char(routenum) seg, rte_group from routes"""
-    secretsfile = pkg_resources.resource_filename(
-        'roundtable_report', 'secrets.json')
-    with open(secretsfile, 'r') as infile:
-        secrets = json.load(infile)
-    engine = secrets['cpc2ds_admin']
-    ora = sa.create_engine(sa.engine.url.URL(
-        engine['dbapi'],
-        username=engine['username'],
-        password=engine['password'],
-        host=engine['host'],
-        port=engine['port'],
-        query=engine['query']))
-    r_grp = pd.read_sql(sa.text(query), ora)
-
-    return pd.merge(
-        r_grp,
-        pd.DataFrame(data=data['route_groups']), on=['rte_group'])
-
-
-def pivot_data(id, params, directory):
+    storage.write_chunks(
+        table, directory, query, fmt, buffer=storage.WRITE_BUFFER)
+
+
+def join_columns(table, columns, sep):
     """
-    Creates a dictionary of pivot tables from the query results
+    Joins the string values of several columns row by row
 
-    :param id: a hyphen-delimited string that translates to the aggregation
-               performed
-    :param params: dict of parameters used to manipulate the source data
-    :param directory: destination directory to export data to
-    :returns: a dict of pandas dataframes ready for visualization
+    :param table: pandas dataframe
+    :param columns: list of string column names (can be empty)
+    :param sep: separator placed between the values
+    :returns: a pandas series of joined values ('' if columns is empty)
     """
-    # Pull extra column information
-    datafile = pkg_resources.resource_filename(
-        'roundtable_report', 'data.json')
-    with open(datafile, 'r') as infile:
-        data = json.load(infile)
-    data['hour_bins'] = {int(k): v for k, v in data['hour_bins'].items()}
-    group_by = ['type'] + params['split_col'] + \
-        [params['idx_col'], 'service_date']
-    if params['pivot_col'] != 'Month':
-        group_by.insert(-2, params['pivot_col'])
-    sys_avg = import_sys_avg()
-    fm_grp = pd.DataFrame(data=data['fare_codes'])
-    fm_grp_bin = pd.DataFrame(data=data['fare_code_bins'])
-    s_fm_grp = pd.DataFrame(data=data['student_fare_codes'])
-    v_fm_grp = pd.DataFrame(data=data['ventra_fare_codes'])
-    r_grp = import_r_grp()
-
-    # Import file piecewise and aggregate each chunk
-    file = pd.read_csv(
-        f"{directory}/{params['datafile']}.csv",
-        chunksize=5 * 10**5)
-    chunks = []
-    for chunk in file:
-        chunk['service_date'] = pd.to_datetime(
-            chunk['service_date'], format='%Y-%m-%d')
-        # System averages adjustment to rides column if needed
-        if params['sa_adj'][0]:
-            chunk = pd.merge(chunk, sys_avg, on=['service_date', 'day_type'])
-            if params['sa_adj'][0] == 'sa':
-                chunk.rides = chunk.rides / chunk.sa
-            elif params['sa_adj'][0] == 'casa':
-                chunk.rides = chunk.rides / chunk.sa * chunk.casa
-        chunk.rides = chunk.rides / params['sa_adj'][1]
-        # Merge extra column information if needed
-        if 'fm_grp' in group_by:
-            chunk = pd.merge(chunk, fm_grp, on=['finance_code'])
-        if 'fm_grp_bin' in group_by:
-            chunk = pd.merge(
-                chunk, fm_grp_bin, on=['finance_code'], how='left')
-            chunk.fm_grp_bin.fillna('Other Rides', inplace=True)
-        if 's_fm_grp' in group_by:
-            chunk = pd.merge(chunk, s_fm_grp, on=['media'])
-        if 'v_fm_grp' in group_by:
-            chunk = pd.merge(chunk, v_fm_grp, on=['fare_prod_name'])
-        if 'seg' in group_by:
-            chunk['seg'] = chunk['seg'].astype(str)
-            chunk = pd.merge(chunk, r_grp, on=['seg'], how='left')
-            chunk['seg'] = chunk.apply(
-                lambda row: row.r_grp if row.type == 'bus' else row.seg,
-                axis=1)
-        if 'time_bin' in group_by:
-            chunk['time_bin'] = chunk['hr'].map(data['hour_bins'])
-        # Aggregate chunk
-        if 'sys' in group_by:
-            group_by_temp = group_by.copy()
-            del group_by_temp[group_by_temp.index('sys')]
-            chunks.append(chunk.groupby(group_by_temp).agg({'rides': 'sum'}))
-        else:
-            chunks.append(chunk.groupby(group_by).agg({'rides': 'sum'}))
-    # Concatenate all chunks and perform a final aggregation to reconcile any
-    # duplicate service_dates induced by chunking
-    if 'sys' in group_by:
+    if not columns:
+        return pd.Series('', index=table.index)
+    key = table[columns[0]]
+    if len(columns) > 1:
+        key = key.str.cat([table[col] for col in columns[1:]], sep=sep)
+
+    return key
+
+
+def plan_scans(reports):
+    """
+    Groups the reports in params.json by the datafile they are built from so
+    that each datafile only has to be read once
+
+    :param reports: dict of ReportPlan objects keyed by report id
+    :returns: a dict of {datafile: {id: plan}}
+    """
+    scans = {}
+    for id, plan in reports.items():
+        scans.setdefault(plan.datafile, {})[id] = plan
+
+    return scans
+
+
+def enrich_chunk(chunk, lookups):
+    """
+    Adds the extra column information needed by any of the reports sharing a
+    datafile to a chunk, in place. Every lookup is applied as a left join;
+    reports relying on an inner join drop the unmatched rows in
+    aggregate_chunk.
+
+    :param chunk: pandas dataframe read from the datafile
+    :param lookups: output of the ReferenceCache.lookups method, for the
+                    joins of every report sharing the datafile
+    :returns: the enriched pandas dataframe
+    """
+    if 'sys_avg' in lookups:
+        lookups['sys_avg'].join(chunk)
+    for col, (name, key, how, fill) in JOINS.items():
+        if name in lookups:
+            lookups[name].join(chunk, fill)
+    if 'r_grp' in lookups:
+        chunk['seg'] = chunk['seg'].astype(str)
+        lookups['r_grp'].join(chunk)
+        # Bus rows are reported by route group
+        chunk['seg'] = chunk['r_grp'].where(chunk['type'] == 'bus',
+                                            chunk['seg'])
+    if 'hour_bins' in lookups:
+        lookups['hour_bins'].join(chunk)
+
+    return chunk
+
+
+def aggregate_chunk(chunk, plan):
+    """
+    Applies a report's rides adjustment to an enriched chunk and aggregates
+    it
+
+    :param chunk: output of the enrich_chunk function
+    :param plan: a ReportPlan
+    :returns: pandas dataframe of partial rides sums indexed by the plan's
+              group_by columns
+    """
+    params = plan.params
+    group_by = list(plan.group_by)
+    mask = pd.Series(True, index=chunk.index)
+    rides = chunk.rides
+    # System averages adjustment to rides column if needed
+    if params['sa_adj'][0]:
+        mask &= chunk.sa.notna()
+        if params['sa_adj'][0] == 'sa':
+            rides = rides / chunk.sa
+        elif params['sa_adj'][0] == 'casa':
+            rides = rides / chunk.sa * chunk.casa
+    rides = rides / params['sa_adj'][1]
+    # Drop rows without a match in the inner-joined tables
+    for col in group_by:
+        if col in JOINS and JOINS[col][2] == 'inner':
+            mask &= chunk[col].notna()
+
+    return chunk.loc[mask, group_by] \
+        .assign(rides=rides[mask]) \
+        .groupby(group_by) \
+        .agg({'rides': 'sum'})
+
+
+def combine_partials(partials, plan):
+    """
+    Concatenates a report's partial aggregates and performs a final
+    aggregation to reconcile any duplicate service_dates induced by chunking
+
+    :param partials: list of outputs of the aggregate_chunk function
+    :param plan: a ReportPlan
+    :returns: pandas dataframe of aggregated rides
+    """
+    group_by = list(plan.group_by)
+    table = pd.concat(partials) \
+        .groupby(group_by) \
+        .agg({'rides': 'sum'}) \
+        .reset_index()
+
+    return system_totals(table, plan)
+
+
+def system_totals(table, plan):
+    """
+    Adds the system-wide rows of a report split by 'sys'
+
+    :param table: pandas dataframe of aggregated rides
+    :param plan: a ReportPlan
+    :returns: pandas dataframe of aggregated rides
+    """
+    if 'sys' in plan.params['split_col']:
         # Add rows with a sum aggregation over the original aggregation
         # columns sans 'type' (need rides values for bus and rail combined)
-        del group_by[group_by.index('sys')]
-        table = pd.concat([chunk for chunk in chunks]) \
-            .groupby(group_by) \
-            .agg({'rides': 'sum'}) \
-            .reset_index()
         table_total = table \
-            .groupby(group_by[1:]) \
+            .groupby(list(plan.group_by)[1:]) \
             .agg({'rides': 'sum'}) \
             .reset_index()
         table_total['type'] = 'system'
         table = pd.concat([table, table_total], sort=False)
-    else:
-        table = pd.concat([chunk for chunk in chunks]) \
-            .groupby(group_by) \
-            .agg({'rides': 'sum'}) \
-            .reset_index()
-    prev_month_start = datetime.combine(date.today(), time.min) - \
-        relativedelta(days=datetime.now().day - 1) - \
-        relativedelta(months=1)
+
+    return table
+
+
+def report_union(reports):
+    """
+    :param reports: dict of ReportPlan objects keyed by report id
+    :returns: the union of the columns needed by the reports, in order
+    """
+    columns = []
+    for plan in reports.values():
+        columns += [col for col in plan.columns if col not in columns]
+
+    return columns
+
+
+def aggregate_chunks(chunks, reports, reference=None, memory_mb=None,
+                     spill_directory=None, months=None):
+    """
+    Aggregates an iterable of source data chunks for every report built from
+    the same query
+
+    :param chunks: iterable of pandas dataframes holding the query results
+    :param reports: dict of ReportPlan objects keyed by report id, all built
+                    from the same query
+    :param reference: ReferenceCache shared across the run (optional)
+    :param memory_mb: memory ceiling of the running aggregates in MB, shared
+                      evenly by the reports (optional, unbounded if not
+                      given)
+    :param spill_directory: folder to spill the running aggregates to
+                            (optional, defaults to the system's temporary
+                            folder)
+    :param months: list of datetimes of the first day of the report months
+                   (optional, defaults to the output of report_month)
+    :returns: a dict of aggregated pandas dataframes keyed by report id
+    """
+    if reference is None:
+        reference = ReferenceCache()
+    columns = report_union(reports)
+    lookups = reference.lookups(
+        set(name for plan in reports.values() for name in plan.joins))
+    # Service date windows of the scan and of each report
+    windows = scan_windows(reports, months)
+    plan_windows = {
+        id: scan_windows({id: plan}, months) for id, plan in reports.items()}
+
+    # Fold each chunk into a running aggregate for every report
+    accumulators = {
+        id: Accumulator(
+            plan.group_by, memory_mb and memory_mb / len(reports),
+            spill_directory)
+        for id, plan in reports.items()}
+    try:
+        for chunk in chunks:
+            if list(chunk.columns) != columns:
+                chunk = chunk.reindex(columns=columns)
+            chunk = storage.parse_dates(chunk)
+            # Drop the rows outside of the reports' windows before joining
+            if windows is not None:
+                chunk = chunk[storage.window_mask(chunk.service_date, windows)]
+            if chunk.empty:
+                continue
+            chunk = enrich_chunk(chunk, lookups)
+            for id, plan in reports.items():
+                part = chunk
+                if plan_windows[id] not in (None, windows):
+                    part = chunk[storage.window_mask(
+                        chunk.service_date, plan_windows[id])]
+                accumulators[id].add(aggregate_chunk(part, plan))
+
+        return {
+            id: system_totals(accumulators[id].result(), plan)
+            for id, plan in reports.items()}
+    finally:
+        for accumulator in accumulators.values():
+            accumulator.close()
+
+
+def scan_datafile(directory, datafile, reports, reference=None,
+                  memory_mb=None, spill_directory=None, months=None):
+    """
+    Reads a datafile once and aggregates it for every report built from it
+
+    :param directory: directory containing the datafile
+    :param datafile: name of the datafile (a key in queries.json)
+    :param reports: dict of ReportPlan objects keyed by report id, all built
+                    from the datafile
+    :param reference: ReferenceCache shared across the run (optional)
+    :param memory_mb: memory ceiling of the running aggregates in MB
+                      (optional, see aggregate_chunks)
+    :param spill_directory: folder to spill the running aggregates to
+                            (optional, see aggregate_chunks)
+    :param months: list of datetimes of the first day of the report months
+                   (optional, see aggregate_chunks)
+    :returns: a dict of aggregated pandas dataframes keyed by report id
+    """
+    chunks = storage.read_chunks(
+        directory, datafile, columns=report_union(reports),
+        windows=scan_windows(reports, months))
+
+    return aggregate_chunks(
+        chunks, reports, reference, memory_mb, spill_directory, months)
+
+
+def pivot_data(plan, directory, reference=None, month=None):
+    """
+    Creates a dictionary of pivot tables from the query results
+
+    :param plan: a ReportPlan
+    :param directory: destination directory to export data to
+    :param reference: ReferenceCache shared across the run (optional)
+    :param month: datetime of the first day of the report month (optional,
+                  defaults to the output of report_month)
+    :returns: a dict of pandas dataframes ready for visualization
+    """
+    table = scan_datafile(
+        directory, plan.datafile, {plan.id: plan}, reference,
+        months=month and [month])[plan.id]
+
+    return build_pivots(plan, directory, table, month)
+
+
+def build_pivots(plan, directory, table, month=None):
+    """
+    Computes the responses of an aggregated table and pivots them
+
+    :param plan: a ReportPlan
+    :param directory: destination directory to export data to
+    :param table: aggregated pandas dataframe (see scan_datafile), which may
+                  span several report months
+    :param month: datetime of the first day of the report month (optional,
+                  defaults to the output of report_month)
+    :returns: a dict of pandas dataframes ready for visualization
+    """
+    params = plan.params
+    group_by = list(plan.group_by)
+    prev_month_start = month or report_month()
+    # Only keep the months of the report month's windows
+    table = table[storage.window_mask(
+        table.service_date,
+        report_windows(plan.months, params_25M(prev_month_start)))]
     prev_13M_start = prev_month_start - relativedelta(years=1)
     # If not pivoting by month, filter to the two months of interest
     if params['pivot_col'] != 'Month':
@@ -264,57 +445,22 @@ def pivot_data(id, params, directory):
             (table.service_date == pd.to_datetime(prev_13M_start))]
 
     # Response calculations and final column cleanup in preparation for pivot
-    vals = list(params['vis_title'].keys())
+    vals = list(plan.responses)
     if 'pct_of_total' in vals:
         # Filter to the 13 months of interest and compute the share percentage
         # of each media type
         table = table[
             (table.service_date <= pd.to_datetime(prev_month_start)) &
             (table.service_date >= pd.to_datetime(prev_13M_start))]
-        table = table.set_index(['type', 'service_date', params['idx_col']]) \
-            .groupby(level=[0, 1], as_index=False) \
-            .apply(lambda row: row['rides'] / row['rides'].sum() * 100) \
-            .reset_index(level=['type', 'service_date', params['idx_col']]) \
-            .reset_index(drop=True) \
-            .rename(columns={'rides': 'pct_of_total'})
-        totals = table.groupby(['type', 'service_date']) \
-            .agg({'pct_of_total': 'sum'}) \
-            .reset_index()
-        totals[params['idx_col']] = 'Total'
-        table = pd.concat([table, totals], sort=False) \
-            .reset_index(drop=True)
+        table = responses.pct_of_total(table, params['idx_col'])
     else:
         # Generate a 'pre' column using a 12-month lookback and calculate
         # raw and percent differences
-        table = table.set_index('service_date')
-        totals = table \
-            .groupby(group_by[:-2]) \
-            .resample('1M')['rides'] \
-            .sum() \
-            .fillna(0) \
-            .reset_index()
-        totals[params['idx_col']] = 'Total'
-        table = table \
-            .groupby(group_by[:-1]) \
-            .resample('1M')['rides'] \
-            .sum() \
-            .fillna(0) \
-            .reset_index()
-        table = pd.concat([table, totals], sort=False) \
-            .reset_index(drop=True)
-        table['pre'] = table \
-            .sort_values(group_by) \
-            .groupby(group_by[:-1])['rides'] \
-            .shift(12)
-        table.dropna(inplace=True)
-        table['pct_diff'] = (table.rides / table.pre - 1) * 100
-        table['diff'] = table.rides - table.pre
-        # table = pd.concat([table, totals], sort=False)
+        table = responses.yoy(table, group_by, params['idx_col'])
     if params['pivot_col'] == 'Month':
         table['Month'] = table.service_date.dt.strftime('%Y-%m')
-    table['key'] = table.apply(
-        lambda row: ' - '.join(
-            [row[col] for col in params['split_col'] if col != 'sys']), axis=1)
+    table['key'] = join_columns(
+        table, [col for col in params['split_col'] if col != 'sys'], ' - ')
 
     # Rename index column, perform categorical column setup as needed
     table.rename(
@@ -323,14 +469,14 @@ def pivot_data(id, params, directory):
 
     # Export formatted data to .csv
     table.reset_index(drop=True, inplace=True)
-    path = os.path.join(directory, params['outfile'])
+    path = plan.path(directory)
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
     print(path)
     table.to_csv(f"{path}/raw_data.csv", index=False)
 
     # Pivot
-    id_label = '|'.join(id.split('-')[2:])
+    id_label = '|'.join(plan.id.split('-')[2:])
     modes = table.type.unique()
     pivot_tables = {
         f"{mode}|{split_key + '|' if split_key else ''}{id_label}|{val}":
@@ -362,7 +508,8 @@ def pivot_data(id, params, directory):
     if params['reorder_col']:
         for label, pivot_table in pivot_tables.items():
             cols = pivot_table.columns
-            newCols = params['reorder_col'][label.split('|')[0]]
+            # Copied, as the plan's params are shared by every table
+            newCols = list(params['reorder_col'][label.split('|')[0]])
             toDel = []
             for col in newCols:
                 if col not in cols:
@@ -388,160 +535,168 @@ def pivot_data(id, params, directory):
     return pivot_tables
 
 
-def graph_mod(params, label, ax1, ax2):
-    """
-    Performs non-universal visualization modifications
-
-    :param params: dict of parameters used to manipulate the source data
-    :param label: a hyphen-delimited string that defines the attributes of
-                  each pivot table
-    :param ax1: a matplotlib.axes.Axes object (main table)
-    :param ax2: a matplotlib.axes.Axes object (aggregated 'Total' row)
-    """
-    if params['idx_col'] == 'time_bin':
-        # Sets yticklabels and cell texts to bold for AM Peak and PM Peak
-        start = end = -1
-        for ticklabel in ax1.get_yticklabels():
-            if ticklabel.get_text().find('AM Peak') != -1:
-                start = ax1.get_yticklabels().index(ticklabel)
-                ticklabel.set_fontproperties(
-                    fnt.FontProperties(weight='bold'))
-            if ticklabel.get_text().find('PM Peak') != -1:
-                end = ax1.get_yticklabels().index(ticklabel)
-                ticklabel.set_fontproperties(
-                    fnt.FontProperties(weight='bold'))
-        xLen = len(ax1.get_xticklabels())
-        if start > -1:
-            for i in range(xLen * start, xLen * (start + 1)):
-                ax1.texts[i].set_weight('bold')
-        if end > -1:
-            for i in range(xLen * end, xLen * (end + 1)):
-                ax1.texts[i].set_weight('bold')
-    elif params['idx_col'] == 'fm_grp':
-        # Draws cell borders that visually group different media
-        if label[label.find("-")] == 'rail':
-            item_idx = [3, 6, 12, 13, 15, 16, 19, 20, 25]
-        else:
-            item_idx = [1, 4, 6, 12, 13, 16, 17, 18, 21, 22, 28]
-        ax1.hlines([x - 0.1 for x in item_idx], *ax1.get_xlim(), linewidth=1.0)
-    elif params['idx_col'] == 'v_fm_grp':
-        # Draws cell borders that visually group different media
-        item_idx = [2, 4, 6, 8, 10, 11]
-        ax1.hlines([x - 0.1 for x in item_idx], *ax1.get_xlim(), linewidth=1.0)
-
-
-def vis_data(params, directory, pivot_tables):
+def vis_data(plan, directory, pivot_tables, pool=None):
     """
     Creates heatmaps of input pandas dataframes using Seaborn/Matplotlib and
     exports them as image files
 
-    :param params: dict of parameters used to manipulate the source data
+    A failure to render one image is reported without stopping the others.
+
+    :param plan: a ReportPlan
     :param directory: destination directory to export data to
     :param pivot_tables: dict of pandas dataframes to visualize
+    :param pool: concurrent.futures.ProcessPoolExecutor to render the images
+                 on (optional, images are rendered in this process if not
+                 given)
+    :returns: a dict of error messages keyed by the label of each image that
+              could not be rendered
+    """
+    import matplotlib.pyplot as plt
+
+    failures = {}
+    tables = {
+        label: table for label, table in pivot_tables.items()
+        if len(table.index) > 0}
+    if pool is None:
+        for label, table in tables.items():
+            try:
+                render_table(plan, directory, label, table)
+            except Exception as e:
+                failures[label] = f"{type(e).__name__}: {e}"
+                plt.close('all')
+    else:
+        futures = {
+            pool.submit(render_table, plan, directory, label, table): label
+            for label, table in tables.items()}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                e = future.exception()
+                failures[futures[future]] = f"{type(e).__name__}: {e}"
+
+    return failures
+
+
+def image_path(plan, directory, label):
     """
+    :param plan: a ReportPlan
+    :param directory: destination directory to export data to
+    :param label: a pipe-delimited string that defines the attributes of the
+                  pivot table (a key of the pivot_data output)
+    :returns: path of the pivot table's image file
+    """
+    split_col = label.split('|')[-len(label.split('|')):-3]
+    split_col.append(label.split('|')[-1])
+    split_col = '-'.join([
+        x.replace('-', '')
+        .replace(' ', '')
+        .replace('/', '') for x in split_col])
+
+    return os.path.join(plan.path(directory), f"{split_col}.png")
+
+
+def render_table(plan, directory, label, table):
+    """
+    Creates the heatmap of a single pivot table and exports it as an image
+    file
+
+    :param plan: a ReportPlan
+    :param directory: destination directory to export data to
+    :param label: a pipe-delimited string that defines the attributes of the
+                  pivot table (a key of the pivot_data output)
+    :param table: pandas dataframe to visualize
+    """
+    # Imported here so only the runs that render images load the plotting
+    # libraries
+    import matplotlib.font_manager as fnt
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    from roundtable_report import heatmap
+
+    params = plan.params
     colors = [x for x in reversed(sns.color_palette("coolwarm", 11))]
-    # Parameters for core data
-    heatmap1 = {
-        'cmap': colors,
-        'robust': True,
-        'annot': True,
-        'fmt': '.1f',
-        'linecolor': 'black',
-        'cbar': False
-    }
-    # Parameters for summary row
-    heatmap2 = {
-        'cmap': [(1, 1, 1)],
-        'robust': True,
-        'annot': True,
-        'fmt': '.1f',
-        'annot_kws': {'weight': 'bold'},
-        'linecolor': "black",
-        'cbar': False
-    }
-    for label, table in pivot_tables.items():
-        if len(table.index) > 0:
-            with plt.style.context("seaborn-white"):
-                # Title generation
-                if len(label.split('|')) == 5:
-                    mode, split, idx, col, val = label.split('|')
-                    title_split = split + ' - '
-                else:
-                    mode, idx, col, val = label.split('|')
-                    title_split = ''
-                if params['focus_tbl'] and val not in params['vis_title']:
-                    title = f"{mode.title()} - " + \
-                        f"{title_split}{params['vis_title'][val[:-1]]}" + \
-                        f" (-{val[-1]}M)"
-                else:
-                    title = f"{mode.title()} - " + \
-                        f"{title_split}{params['vis_title'][val]}"
-                # Overall figure size and relative size of the two subplots
-                # scaled to the number of rows in the table
-                if params['focus_tbl'] and val not in params['vis_title']:
-                    fig, (ax1, ax2) = plt.subplots(
-                        figsize=(params['focus_tbl'], len(table.index) / 3.5),
-                        nrows=2,
-                        gridspec_kw={'height_ratios': [len(table.index), 1]})
-                else:
-                    fig, (ax1, ax2) = plt.subplots(
-                        figsize=(12, len(table.index) / 3.5),
-                        nrows=2,
-                        gridspec_kw={'height_ratios': [len(table.index), 1]})
-                fig.subplots_adjust(hspace=(0.2 / len(table.index)))
-                sns.heatmap(table[:-1], **heatmap1, ax=ax1)
-                sns.heatmap(table[-1:], **heatmap2, ax=ax2)
-                # Append '%' to cell values if response is a percentage
-                if label.find("pct") > -1:
-                    for t in ax1.texts:
-                        t.set_text(t.get_text() + " %")
-                    for t in ax2.texts:
-                        t.set_text(t.get_text() + " %")
-                # Move x-axis labels to top of plot
-                ax1.xaxis.tick_top()
-                ax1.xaxis.set_label_position('top')
-                ax2.xaxis.set_visible(False)
-                ax2.yaxis.set_label_text('')
-                # Align the 'Total' label vertically with the rest of the row
-                for ticklabel in ax2.get_yticklabels():
-                    ticklabel.set_fontproperties(
-                        fnt.FontProperties(weight='bold'))
-                    ticklabel.set_verticalalignment("center")
-                # De-rotate tick labels
-                ax1.tick_params(
-                    axis='both',
-                    which='both',
-                    left=False,
-                    top=False,
-                    labelrotation=0
-                )
-                ax2.tick_params(
-                    axis='both',
-                    which='both',
-                    left=False,
-                    bottom=False,
-                    labelbottom=False,
-                    labelrotation=0
-                )
-                # Cosmetic changes
-                ax1.set_title(title, fontsize=12, fontweight='bold')
-                ax1.set_xlabel(
-                    table.columns.name, fontweight="bold", labelpad=8)
-                ax1.set_ylabel(
-                    table.index.name, fontweight="bold", labelpad=10)
-                graph_mod(params, label, ax1, ax2)
-                # Image export
-                split_col = label.split('|')[-len(label.split('|')):-3]
-                split_col.append(label.split('|')[-1])
-                split_col = '-'.join([
-                    x.replace('-', '')
-                    .replace(' ', '')
-                    .replace('/', '') for x in split_col])
-                path = os.path.join(directory, params['outfile'])
-                if not os.path.exists(path):
-                    os.makedirs(path, exist_ok=True)
-                plt.savefig(
-                    f"{path}/{split_col}",
-                    bbox_inches='tight')
-                fig.clf()
-                plt.close()
+    with plt.style.context("seaborn-white"):
+        # Title generation
+        if len(label.split('|')) == 5:
+            mode, split, idx, col, val = label.split('|')
+            title_split = split + ' - '
+        else:
+            mode, idx, col, val = label.split('|')
+            title_split = ''
+        if params['focus_tbl'] and val not in params['vis_title']:
+            title = f"{mode.title()} - " + \
+                f"{title_split}{params['vis_title'][val[:-1]]}" + \
+                f" (-{val[-1]}M)"
+        else:
+            title = f"{mode.title()} - " + \
+                f"{title_split}{params['vis_title'][val]}"
+        # Overall figure size and relative size of the two subplots
+        # scaled to the number of rows in the table
+        if params['focus_tbl'] and val not in params['vis_title']:
+            fig, (ax1, ax2) = plt.subplots(
+                figsize=(params['focus_tbl'], len(table.index) / 3.5),
+                nrows=2,
+                gridspec_kw={'height_ratios': [len(table.index), 1]})
+        else:
+            fig, (ax1, ax2) = plt.subplots(
+                figsize=(12, len(table.index) / 3.5),
+                nrows=2,
+                gridspec_kw={'height_ratios': [len(table.index), 1]})
+        fig.subplots_adjust(hspace=(0.2 / len(table.index)))
+        # Core data, then the summary row; '%' is appended to cell values if
+        # the response is a percentage
+        suffix = " %" if label.find("pct") > -1 else ""
+        bold_rows, rules = heatmap.table_rules(
+            plan, label, table.index[:-1])
+        heatmap.draw_heatmap(
+            ax1, table[:-1], colors, suffix=suffix, bold_rows=bold_rows)
+        heatmap.draw_heatmap(
+            ax2, table[-1:], [(1, 1, 1)], suffix=suffix,
+            annot_kws={'weight': 'bold'})
+        # Move x-axis labels to top of plot
+        ax1.xaxis.tick_top()
+        ax1.xaxis.set_label_position('top')
+        ax2.xaxis.set_visible(False)
+        ax2.yaxis.set_label_text('')
+        # Align the 'Total' label vertically with the rest of the row
+        for ticklabel in ax2.get_yticklabels():
+            ticklabel.set_fontproperties(
+                fnt.FontProperties(weight='bold'))
+            ticklabel.set_verticalalignment("center")
+        # De-rotate tick labels
+        ax1.tick_params(
+            axis='both',
+            which='both',
+            left=False,
+            top=False,
+            labelrotation=0
+        )
+        ax2.tick_params(
+            axis='both',
+            which='both',
+            left=False,
+            bottom=False,
+            labelbottom=False,
+            labelrotation=0
+        )
+        # Cosmetic changes
+        ax1.set_title(title, fontsize=12, fontweight='bold')
+        ax1.set_xlabel(
+            table.columns.name, fontweight="bold", labelpad=8)
+        ax1.set_ylabel(
+            table.index.name, fontweight="bold", labelpad=10)
+        # Set AM Peak and PM Peak rows in bold, and draw cell borders that
+        # visually group different media
+        yticklabels = ax1.get_yticklabels()
+        for row in bold_rows:
+            yticklabels[row].set_fontproperties(
+                fnt.FontProperties(weight='bold'))
+        if rules:
+            ax1.hlines(rules, *ax1.get_xlim(), linewidth=1.0)
+        # Image export
+        path = image_path(plan, directory, label)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        plt.savefig(path, bbox_inches='tight')
+        fig.clf()
+        plt.close()
@@ -0,0 +1,134 @@
+import matplotlib.colors as mcolors
+import numpy as np
+import pandas as pd
+
+# Cell borders that visually group different media, drawn above these rows
+FM_GRP_RULES = {
+    'rail': [3, 6, 12, 13, 15, 16, 19, 20, 25],
+    'bus': [1, 4, 6, 12, 13, 16, 17, 18, 21, 22, 28]
+}
+V_FM_GRP_RULES = [2, 4, 6, 8, 10, 11]
+
+
+def table_rules(plan, label, index):
+    """
+    Lists the non-universal visualization modifications of a table: the
+    rows set in bold and the rows with a border drawn above them
+
+    :param plan: a ReportPlan
+    :param label: a pipe-delimited string that defines the attributes of the
+                  pivot table
+    :param index: index of the table's main rows (the 'Total' row excluded)
+    :returns: a (set of bold row positions, list of border positions) tuple
+    """
+    idx_col = plan.params['idx_col']
+    bold = set()
+    rules = []
+    if idx_col == 'time_bin':
+        # AM Peak and PM Peak are set in bold
+        for row, value in enumerate(index):
+            if 'AM Peak' in str(value) or 'PM Peak' in str(value):
+                bold.add(row)
+    elif idx_col == 'fm_grp':
+        # A single character never equals 'rail', so bus borders are always
+        # drawn; kept as the original renderer had it
+        if label[label.find("-")] == 'rail':
+            rules = FM_GRP_RULES['rail']
+        else:
+            rules = FM_GRP_RULES['bus']
+    elif idx_col == 'v_fm_grp':
+        rules = V_FM_GRP_RULES
+
+    return bold, [x - 0.1 for x in rules]
+
+
+def relative_luminance(colors):
+    """
+    :param colors: numpy array of RGBA colors (one per row)
+    :returns: numpy array of the relative luminance of each color
+    """
+    rgb = colors[:, :3]
+    rgb = np.where(
+        rgb <= .03928, rgb / 12.92, ((rgb + .055) / 1.055) ** 2.4)
+
+    return rgb.dot([.2126, .7152, .0722])
+
+
+def tick_labels(index):
+    """
+    :param index: pandas index of the table's rows or columns
+    :returns: list of tick labels (MultiIndex levels joined by '-')
+    """
+    if isinstance(index, pd.MultiIndex):
+        return ['-'.join(map(str, x)) for x in index.values]
+
+    return list(index)
+
+
+def axis_label(index):
+    """
+    :param index: pandas index of the table's rows or columns
+    :returns: axis label (MultiIndex names joined by '-')
+    """
+    if isinstance(index, pd.MultiIndex):
+        return '-'.join(map(str, index.names))
+
+    return index.name or ''
+
+
+def draw_heatmap(ax, table, colors, fmt='.1f', suffix='', bold_rows=(),
+                 annot_kws=None):
+    """
+    Draws an annotated heatmap of a table on an axes, laid out as
+    seaborn.heatmap(robust=True, annot=True, cbar=False) lays it out
+
+    The cells are drawn with a single pcolormesh and each annotation is
+    formatted once, its text colour picked from the luminance of its cell.
+    Unlike seaborn, every row and column is labelled and the tick labels are
+    never rotated, so the figure doesn't have to be drawn to check them for
+    overlaps.
+
+    :param ax: a matplotlib.axes.Axes object
+    :param table: pandas dataframe to visualize
+    :param colors: list of colors of the colormap
+    :param fmt: format of the annotations
+    :param suffix: text appended to each annotation (e.g. ' %')
+    :param bold_rows: positions of the rows whose annotations are set in bold
+    :param annot_kws: keyword arguments of every annotation (optional)
+    :returns: the QuadMesh of the cells
+    """
+    values = table.to_numpy(dtype=float)
+    data = np.ma.masked_invalid(values)
+    cmap = mcolors.ListedColormap(colors)
+    if data.count():
+        vmin, vmax = np.nanpercentile(values, [2, 98])
+    else:
+        vmin = vmax = None
+    mesh = ax.pcolormesh(
+        data, cmap=cmap, vmin=vmin, vmax=vmax, linewidths=0,
+        edgecolor='black')
+    nrows, ncols = values.shape
+    ax.set(xlim=(0, ncols), ylim=(0, nrows))
+    ax.invert_yaxis()
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.set_xticks(np.arange(ncols) + .5)
+    ax.set_xticklabels(tick_labels(table.columns))
+    ax.set_yticks(np.arange(nrows) + .5)
+    ax.set_yticklabels(tick_labels(table.index), va='center')
+    ax.set(xlabel=axis_label(table.columns), ylabel=axis_label(table.index))
+
+    # Annotate the cells with the formatted values
+    rows, cols = np.nonzero(~np.ma.getmaskarray(data))
+    luminance = relative_luminance(
+        cmap(mesh.norm(values[rows, cols])))
+    for row, col, value, lum in zip(
+            rows, cols, values[rows, cols], luminance):
+        kwargs = {'color': '.15' if lum > .408 else 'w',
+                  'ha': 'center', 'va': 'center'}
+        if row in bold_rows:
+            kwargs['weight'] = 'bold'
+        kwargs.update(annot_kws or {})
+        ax.text(col + .5, row + .5, f"{value:{fmt}}{suffix}", **kwargs)
+
+    return mesh
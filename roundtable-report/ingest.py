@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import json
+import os
+
+from roundtable_report import functions as rrf
+from roundtable_report import storage
+from roundtable_report.executor import (
+    SHARD_FORMAT, concat_shards, fetch_shard, month_shards)
+
+
+def store_directory(root, query):
+    """
+    :param root: folder holding the rolling store of every query
+    :param query: name of the query
+    :returns: path of the folder holding a query's month partitions
+    """
+    return os.path.join(root, query)
+
+
+def partition_name(shard):
+    """
+    :param shard: one of the outputs of the month_shards function
+    :returns: name of the shard's month partition ('%Y-%m')
+    """
+    return datetime.strptime(shard['from_date'], '%Y%m%d').strftime('%Y-%m')
+
+
+def load_manifest(store):
+    """
+    Loads the manifest of a query's store, which records the partitions that
+    were fetched and the months marked stale
+
+    :param store: output of the store_directory function
+    :returns: a dict with 'partitions' ({month: {'rows', 'fetched'}}) and
+              'stale' (list of months) entries
+    """
+    path = os.path.join(store, 'manifest.json')
+    if not os.path.exists(path):
+        return {'partitions': {}, 'stale': []}
+    with open(path, 'r') as infile:
+        return json.load(infile)
+
+
+def save_manifest(store, manifest):
+    """
+    Writes the manifest of a query's store
+
+    :param store: output of the store_directory function
+    :param manifest: output of the load_manifest function
+    """
+    os.makedirs(store, exist_ok=True)
+    path = os.path.join(store, 'manifest.json')
+    with open(f"{path}.tmp", 'w') as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def mark_stale(root, queries, months):
+    """
+    Marks month partitions to be fetched again on the next ingest, e.g. after
+    late-arriving corrections
+
+    :param root: folder holding the rolling store of every query
+    :param queries: list of query names (keys in queries.json)
+    :param months: list of months ('%Y-%m')
+    """
+    for query in queries:
+        store = store_directory(root, query)
+        manifest = load_manifest(store)
+        manifest['stale'] = sorted(set(manifest['stale']) | set(months))
+        save_manifest(store, manifest)
+
+
+def ingest(queries, root, directory, fmt='parquet', workers=4, refresh=False,
+           params=None, chunksize=storage.CHUNKSIZE, stop=None):
+    """
+    Brings each query's month-partitioned store up to date with the query
+    window and exports it to the query's datafile
+
+    Only the months that are missing from a store or marked stale are
+    queried; partitions older than the window are dropped.
+
+    :param queries: list of query names (keys in queries.json)
+    :param root: folder holding the rolling store of every query
+    :param directory: destination directory to export data to
+    :param fmt: datafile format, one of 'parquet', 'arrow' or 'csv'
+    :param workers: maximum number of months fetched at once
+    :param refresh: fetch every month of the window again
+    :param params: query window (optional, defaults to params_25M)
+    :param chunksize: number of rows fetched per chunk
+    :param stop: threading.Event telling the running months to give up
+                 after their current chunk and the others not to start
+                 (optional)
+    :returns: an iterator of (query name, list of months fetched) tuples,
+              yielded as each datafile is created
+    """
+    shards = month_shards(params or rrf.params_25M())
+    months = [partition_name(shard) for shard in shards]
+    manifests = {
+        query: load_manifest(store_directory(root, query))
+        for query in queries}
+
+    # Drop the partitions that fell out of the window
+    for query, manifest in manifests.items():
+        store = store_directory(root, query)
+        for month in set(manifest['partitions']) - set(months):
+            path = storage.datafile_path(store, month, SHARD_FORMAT)
+            if os.path.exists(path):
+                os.remove(path)
+            del manifest['partitions'][month]
+        manifest['stale'] = [x for x in manifest['stale'] if x in months]
+        save_manifest(store, manifest)
+
+    # Fetch the missing and stale months
+    fetch = {
+        query: [
+            shard for shard in shards
+            if refresh or
+            partition_name(shard) not in manifest['partitions'] or
+            partition_name(shard) in manifest['stale']]
+        for query, manifest in manifests.items()}
+    for query in queries:
+        if not fetch[query]:
+            concat_shards(
+                query, months, store_directory(root, query), directory, fmt)
+            yield query, []
+    pending = {query: len(fetch[query]) for query in queries}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                _fetch_partition, query, shard, store_directory(root, query),
+                chunksize, stop): (query, partition_name(shard))
+            for query in queries
+            for shard in fetch[query]}
+        try:
+            for future in as_completed(futures):
+                if stop is not None and stop.is_set():
+                    break
+                query, month = futures[future]
+                if future.exception() is not None:
+                    raise future.exception()
+                manifest = manifests[query]
+                manifest['partitions'][month] = {
+                    'rows': future.result(),
+                    'fetched': datetime.now().isoformat(timespec='seconds')}
+                if month in manifest['stale']:
+                    manifest['stale'].remove(month)
+                save_manifest(store_directory(root, query), manifest)
+                pending[query] -= 1
+                if pending[query] == 0:
+                    concat_shards(
+                        query, months, store_directory(root, query),
+                        directory, fmt)
+                    yield query, [
+                        partition_name(shard) for shard in fetch[query]]
+        finally:
+            # Don't start the remaining months if one of them failed or the
+            # consumer stopped early
+            for future in futures:
+                future.cancel()
+
+
+def _fetch_partition(query, shard, store, chunksize=storage.CHUNKSIZE,
+                     stop=None):
+    """
+    Fetches one month partition, replacing the existing file only once the
+    new one is complete
+
+    :param query: name of the query (a key in queries.json)
+    :param shard: one of the outputs of the month_shards function
+    :param store: output of the store_directory function
+    :param chunksize: number of rows fetched per chunk
+    :param stop: threading.Event telling the fetch to give up (optional, see
+                 fetch_shard)
+    :returns: number of rows written
+    """
+    month = partition_name(shard)
+    rows = fetch_shard(query, shard, store, f".{month}", chunksize, stop)
+    temp = storage.datafile_path(store, f".{month}", SHARD_FORMAT)
+    path = storage.datafile_path(store, month, SHARD_FORMAT)
+    if os.path.exists(temp):
+        os.replace(temp, path)
+    elif os.path.exists(path):
+        # The month no longer has any rows
+        os.remove(path)
+
+    return rows
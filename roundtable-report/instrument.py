@@ -0,0 +1,190 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def print_log(msg):
+    print(f"{datetime.now(): %Y-%m-%d %H:%M:%S}: {msg}")
+
+
+def max_rss_mb():
+    """
+    :returns: peak resident set size of the process so far, in MB (None if
+              it can't be measured)
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return round(rss / (1024**2 if sys.platform == 'darwin' else 1024), 1)
+
+
+class Trace:
+    """
+    Records the duration, row counts and memory of each stage of a run as a
+    list of JSON-serializable events
+
+    Every stage records its wall-clock duration and the peak resident set
+    size of the process. With memory=True, tracemalloc also records the peak
+    memory allocated by Python within each stage; tracing slows the run
+    down, so it is opt-in.
+
+    :param memory: trace Python memory allocations with tracemalloc
+    :param verbose: print a line as each stage completes
+    """
+
+    def __init__(self, memory=False, verbose=True):
+        self.memory = memory
+        self.verbose = verbose
+        self.started = datetime.now()
+        self.events = []
+        self._start = time.perf_counter()
+        self._open = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Records a stage of the run
+
+        The yielded dict is the stage's event; counts known only once the
+        stage has run (e.g. 'rows_out') can be added to it.
+
+        :param name: name of the stage (e.g. 'scan', 'pivot', 'render')
+        :param fields: identifying fields of the event (e.g. report=id)
+        :returns: a context manager yielding the event dict
+        """
+        event = dict(stage=name, **fields)
+        event['offset'] = round(time.perf_counter() - self._start, 3)
+        if self.memory:
+            self._track_peak()
+            event['peak_traced_mb'] = 0
+        self._open.append(event)
+        start = time.perf_counter()
+        try:
+            yield event
+        except Exception as e:
+            event['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            event['seconds'] = round(time.perf_counter() - start, 3)
+            if self.memory:
+                self._track_peak()
+            self._open.remove(event)
+            event['max_rss_mb'] = max_rss_mb()
+            self.events.append(event)
+            if self.verbose:
+                counts = ', '.join(
+                    f"{k}={v}" for k, v in event.items()
+                    if k not in ['stage', 'offset', 'seconds'])
+                print_log(
+                    f"{name} complete in {event['seconds']:.2f}s ({counts})")
+
+    def event(self, name, parent=None, **fields):
+        """
+        Records a point in time, within a stage if a parent is given (e.g. a
+        query's datafile being created)
+
+        :param name: name of the event
+        :param parent: event dict yielded by the stage method (optional)
+        :param fields: identifying fields of the event
+        """
+        offset = time.perf_counter() - self._start
+        event = dict(stage=name, **fields, offset=round(offset, 3))
+        if parent is not None:
+            event['parent'] = parent['stage']
+            event['seconds'] = round(offset - parent['offset'], 3)
+        self.events.append(event)
+        if self.verbose:
+            counts = ', '.join(f"{k}={v}" for k, v in fields.items())
+            print_log(f"{name}: {counts}")
+
+    def chunks(self, chunks, event, **fields):
+        """
+        Passes an iterable of dataframes through, counting its chunks and
+        rows in a stage's event and recording one 'chunk' event each (with
+        the time taken to produce the chunk)
+
+        :param chunks: iterable of pandas dataframes
+        :param event: event dict yielded by the stage method
+        :param fields: identifying fields of the chunk events
+        :returns: an iterator of the same dataframes
+        """
+        event.setdefault('chunks', 0)
+        event.setdefault('rows_in', 0)
+        start = time.perf_counter()
+        for chunk in chunks:
+            self.events.append(dict(
+                stage='chunk', parent=event['stage'], **fields,
+                index=event['chunks'], rows=len(chunk),
+                offset=round(start - self._start, 3),
+                seconds=round(time.perf_counter() - start, 3)))
+            event['chunks'] += 1
+            event['rows_in'] += len(chunk)
+            yield chunk
+            start = time.perf_counter()
+
+    def save(self, path):
+        """
+        Writes the trace to a JSON file
+
+        :param path: path to the JSON file
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump({
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round(time.perf_counter() - self._start, 3),
+                'max_rss_mb': max_rss_mb(),
+                'events': self.events}, outfile, indent=1)
+
+    def _track_peak(self):
+        """
+        Folds the tracemalloc peak since the last reset into every open stage
+        and starts a new measurement
+        """
+        peak = round(tracemalloc.get_traced_memory()[1] / 1024**2, 1)
+        for event in self._open:
+            event['peak_traced_mb'] = max(event['peak_traced_mb'], peak)
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def profile(path, enabled=True):
+    """
+    Captures a cProfile of the wrapped code, keeping the raw stats and a
+    text summary sorted by cumulative time
+
+    :param path: path of the raw stats file ('.prof'); the summary is written
+                 next to it with a '.txt' extension
+    :param enabled: whether to profile at all
+    :returns: a context manager
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler.dump_stats(path)
+        with open(f"{os.path.splitext(path)[0]}.txt", 'w') as outfile:
+            pstats.Stats(profiler, stream=outfile) \
+                .sort_stats('cumulative') \
+                .print_stats(40)
@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import sqlalchemy as sa
+
+from roundtable_report import config
+from roundtable_report import functions as rrf
+from roundtable_report import storage
+from roundtable_report.config import JOINS
+from roundtable_report.db import get_engine
+from roundtable_report.reference import ReferenceCache
+
+
+def lookup_cte(name, index, binds, dual=''):
+    """
+    Inlines a lookup table as a common table expression, with its values
+    passed as bound parameters
+
+    :param name: name of the common table expression
+    :param index: a LookupIndex
+    :param binds: list the bound parameters are appended to
+    :param dual: table selected from when there is no table (' from dual' on
+                 Oracle)
+    :returns: the common table expression's SQL text
+    """
+    table = index.index.to_frame(index=False)
+    for col, values in index.values.items():
+        table[col] = values
+    selects = []
+    for row in table.itertuples(index=False, name=None):
+        cols = []
+        for col, value in zip(table.columns, row):
+            if pd.isna(value):
+                value = None
+            elif isinstance(value, pd.Timestamp):
+                value = value.date()
+            elif hasattr(value, 'item'):
+                # numpy scalars aren't understood by every driver
+                value = value.item()
+            bind = f"b{len(binds)}"
+            binds.append(sa.bindparam(
+                bind, value,
+                type_=sa.Date if pd.api.types.is_datetime64_any_dtype(
+                    table[col]) else None))
+            cols.append(f":{bind} as {col}")
+        selects.append(f"select {', '.join(cols)}{dual}")
+    if not selects:
+        cols = ', '.join(f"null as {col}" for col in table.columns)
+        selects.append(f"select {cols}{dual} where 1 = 0")
+
+    return f"{name} as (\n  " + "\n  union all ".join(selects) + "\n)"
+
+
+def report_sql(query, plan, lookups, dialect='oracle'):
+    """
+    Wraps a query's text in the aggregation performed by a report, so that
+    only the aggregated rows leave the database
+
+    The lookup tables are inlined as common table expressions, rides are
+    adjusted by the system averages when needed and every row with a null
+    aggregation column is dropped, as the pandas groupby does. Neither the
+    division by sa_adj[1] nor the 'sys' totals are applied; both are left to
+    pandas (see aggregate_query).
+
+    :param query: SQL text of the query (a value in queries.json)
+    :param plan: a ReportPlan
+    :param lookups: output of the ReferenceCache.lookups method
+    :param dialect: name of the database dialect
+    :returns: a SQLAlchemy text clause with its lookup values bound
+    """
+    dual = ' from dual' if dialect == 'oracle' else ''
+    params = plan.params
+    group_by = plan.group_by
+    binds = []
+    ctes = [f"src as (\n{query.strip().rstrip(';')}\n)"]
+    joins = []
+    cols = {}
+    for col in group_by:
+        if col in JOINS:
+            name, key, how, fill = JOINS[col]
+            ctes.append(lookup_cte(name, lookups[name], binds, dual))
+            joins.append(
+                f"{'' if how == 'inner' else 'left '}join {name} "
+                f"on {name}.{key} = s.{key}")
+            if fill is None:
+                cols[col] = f"{name}.{col}"
+            else:
+                binds.append(sa.bindparam(f"b{len(binds)}", fill))
+                cols[col] = f"coalesce({name}.{col}, :b{len(binds) - 1})"
+        elif col == 'seg':
+            # Bus rows are reported by route group
+            ctes.append(lookup_cte('r_grp', lookups['r_grp'], binds, dual))
+            joins.append("left join r_grp on r_grp.seg = to_char(s.seg)")
+            cols[col] = \
+                "case when s.type = 'bus' then r_grp.r_grp " \
+                "else to_char(s.seg) end"
+        elif col == 'time_bin':
+            ctes.append(
+                lookup_cte('hour_bins', lookups['hour_bins'], binds, dual))
+            joins.append("left join hour_bins on hour_bins.hr = s.hr")
+            cols[col] = "hour_bins.time_bin"
+        else:
+            cols[col] = f"s.{col}"
+    # System averages adjustment to rides column if needed
+    rides = 's.rides'
+    where = ''
+    if params['sa_adj'][0]:
+        ctes.append(lookup_cte('sys_avg', lookups['sys_avg'], binds, dual))
+        joins.append(
+            "join sys_avg on sys_avg.service_date = s.service_date "
+            "and sys_avg.day_type = s.day_type")
+        if params['sa_adj'][0] == 'sa':
+            rides = 's.rides * 1.0 / sys_avg.sa'
+        elif params['sa_adj'][0] == 'casa':
+            rides = 's.rides * 1.0 / sys_avg.sa * sys_avg.casa'
+        where = "\n  where sys_avg.sa is not null"
+
+    select = ',\n    '.join(
+        [f"{expr} as {col}" for col, expr in cols.items()] +
+        [f"{rides} as rides"])
+    not_null = ' and '.join(f"{col} is not null" for col in group_by)
+    text = \
+        "with " + ",\n".join(ctes) + "\n" \
+        f"select {', '.join(group_by)}, sum(rides) as rides\n" \
+        f"from (\n  select\n    {select}\n  from src s\n  " + \
+        "\n  ".join(joins) + where + "\n) t\n" \
+        f"where {not_null}\n" \
+        f"group by {', '.join(group_by)}"
+
+    return sa.text(text).bindparams(*binds)
+
+
+def aggregate_query(query, reports, reference=None, workers=4, params=None):
+    """
+    Runs the aggregation of every report built from a query in the database
+    instead of exporting and scanning the query's datafile
+
+    :param query: name of the query (a key in queries.json)
+    :param reports: dict of ReportPlan objects keyed by report id, all built
+                    from the query
+    :param reference: ReferenceCache shared across the run (optional)
+    :param workers: maximum number of reports aggregated at once
+    :param params: query window (optional, defaults to params_25M)
+    :returns: a dict of aggregated pandas dataframes keyed by report id,
+              matching the output of the scan_datafile function
+    """
+    if reference is None:
+        reference = ReferenceCache()
+    text = config.load().queries[query]
+    dialect = get_engine().dialect.name
+    params = params or rrf.params_25M()
+    # Load every lookup up front, as the reference cache isn't shared safely
+    # between threads
+    lookups = reference.lookups(
+        set(name for plan in reports.values() for name in plan.joins))
+
+    def aggregate(plan):
+        sql = report_sql(text, plan, lookups, dialect)
+        tables = []
+        # Only the months within the report's window are aggregated
+        for window in rrf.report_windows(plan.months, params):
+            table = pd.read_sql(sql, get_engine(), params=window)
+            table = storage.parse_dates(table)
+            # Groups whose rides are all null sum to 0 in pandas
+            table['rides'] = \
+                table['rides'].fillna(0) / plan.params['sa_adj'][1]
+            tables.append(table)
+        return rrf.combine_partials(tables, plan)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tables = pool.map(aggregate, reports.values())
+        return dict(zip(reports, tables))
@@ -0,0 +1,274 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from roundtable_report import config
+from roundtable_report.config import JOINS
+
+
+def import_sys_avg():
+    """
+    Imports the system_averages table into a pandas dataframe and transforms
+    the results for use with the main aggregation table
+
+    :returns: pandas dataframe of transformed query results
+    """
+    # Imported here so a run served from the on-disk reference tables never
+    # loads SQLAlchemy
+    import sqlalchemy as sa
+    from roundtable_report.db import connect
+
+    # Perform query
+    query = """
+    select year, month, wk, sa, su, cawk, casa, casu
+    from system_averages"""
+    with connect() as con:
+        system_averages = pd.read_sql(sa.text(query), con)
+
+    # Melt system average and calendar-adjusted system average columns
+    sys_avg = pd.melt(system_averages,
+                      id_vars=['year', 'month'],
+                      value_vars=['wk', 'sa', 'su'],
+                      var_name='daytype',
+                      value_name='sa')
+    cal_sys_avg = pd.melt(system_averages,
+                          id_vars=['year', 'month'],
+                          value_vars=['cawk', 'casa', 'casu'],
+                          var_name='daytype',
+                          value_name='casa')
+
+    # Merge melted columns and format date and day_type columns to merge with
+    # the main aggregation table
+    cal_sys_avg.daytype = cal_sys_avg.daytype.apply(lambda x: x[2:])
+    system_averages = pd.merge(
+        sys_avg, cal_sys_avg, on=['year', 'month', 'daytype'])
+    system_averages['day_type'] = system_averages.daytype.apply(
+        lambda x: 'W' if x == 'wk' else x[-1].upper())
+    system_averages['service_date'] = pd.to_datetime(
+        (system_averages.year.astype(str) +
+         system_averages.month.astype(str).str.zfill(2)),
+        format="%Y%m")
+
+    return system_averages
+
+
+def import_routes():
+    """
+    Imports bus route information into a pandas dataframe
+
+    :returns: pandas dataframe with 'seg' and 'rte_group' columns
+    """
+    import sqlalchemy as sa
+    from roundtable_report.db import connect
+
+    query = """
+    select to_char(routenum) seg, rte_group from routes"""
+    with connect() as con:
+        return pd.read_sql(sa.text(query), con)
+
+
+def merge_route_groups(routes, data=None):
+    """
+    Merges the relevant dict containing the new row names into the bus route
+    information
+
+    :param routes: output of the import_routes function
+    :param data: contents of data.json (optional, taken from the loaded
+                 configuration if not given)
+    :returns: pandas dataframe of modified query results
+    """
+    if data is None:
+        data = config.load().data
+
+    return pd.merge(
+        routes,
+        pd.DataFrame(data=data['route_groups']), on=['rte_group'])
+
+
+def import_r_grp(data=None):
+    """
+    Imports bus route information into a pandas dataframe and merges the
+    relevant dict containing the new row names
+
+    :param data: contents of data.json (optional, taken from the loaded
+                 configuration if not given)
+    :returns: pandas dataframe of modified query results
+    """
+    return merge_route_groups(import_routes(), data)
+
+
+class LookupIndex:
+    """
+    A lookup table compiled into a hash index over its key columns and arrays
+    of its value columns, used to add the value columns to a chunk in place
+    instead of merging (and copying) the whole chunk
+
+    Keys are expected to be unique; only the first row of a duplicated key is
+    used.
+
+    :param table: pandas dataframe of the lookup table
+    :param keys: list of key column names
+    :param columns: list of value column names (optional, defaults to every
+                    non-key column)
+    """
+
+    def __init__(self, table, keys, columns=None):
+        table = table.drop_duplicates(keys)
+        self.keys = keys
+        if len(keys) == 1:
+            self.index = pd.Index(table[keys[0]])
+        else:
+            self.index = pd.MultiIndex.from_frame(table[keys])
+        if columns is None:
+            columns = [col for col in table.columns if col not in keys]
+        self.values = {col: table[col].to_numpy() for col in columns}
+
+    def positions(self, chunk):
+        """
+        :param chunk: pandas dataframe containing the key columns
+        :returns: numpy array of the matching lookup row of each chunk row
+                  (-1 if unmatched)
+        """
+        if len(self.keys) == 1:
+            return self.index.get_indexer(chunk[self.keys[0]])
+        return self.index.get_indexer(
+            pd.MultiIndex.from_frame(chunk[self.keys]))
+
+    def join(self, chunk, fill=None):
+        """
+        Adds the value columns to a chunk in place (a left join)
+
+        :param chunk: pandas dataframe containing the key columns
+        :param fill: value of unmatched rows (optional, defaults to NaN)
+        :returns: boolean numpy array of the matched rows
+        """
+        positions = self.positions(chunk)
+        matched = positions >= 0
+        for col, values in self.values.items():
+            if len(values) == 0:
+                values = np.array([np.nan], dtype=object)
+            chunk[col] = np.where(
+                matched, values.take(positions),
+                np.nan if fill is None else fill)
+
+        return matched
+
+
+class ReferenceCache:
+    """
+    Loads the reference tables shared by every report (system averages, route
+    groups and the data.json lookups) once per run
+
+    When a directory is given, the database tables are also kept on disk in
+    its 'reference' folder. Since the directory is the report month folder,
+    a later run for the same month reads them back without querying the
+    database.
+
+    :param directory: report month directory to keep the on-disk copy in
+                      (optional, no copy is kept if not given)
+    :param refresh: ignore an existing on-disk copy and query the database
+    """
+
+    def __init__(self, directory=None, refresh=False):
+        self.directory = directory
+        self.refresh = refresh
+        self._data = None
+        self._tables = {}
+        self._indexes = {}
+
+    @property
+    def data(self):
+        """
+        Contents of data.json, with the 'hour_bins' keys converted to int
+        """
+        if self._data is None:
+            data = config.load().data
+            self._data = dict(data, hour_bins={
+                int(k): v for k, v in data.get('hour_bins', {}).items()})
+        return self._data
+
+    def sys_avg(self):
+        """
+        :returns: output of the import_sys_avg function
+        """
+        return self._load('sys_avg', import_sys_avg)
+
+    def r_grp(self):
+        """
+        :returns: output of the import_r_grp function; only the routes query
+                  result is kept on disk, so that edits to the data.json
+                  route_groups apply to the next run
+        """
+        if 'r_grp' not in self._tables:
+            self._tables['r_grp'] = merge_route_groups(
+                self._load('routes', import_routes), self.data)
+        return self._tables['r_grp']
+
+    def lookup(self, name):
+        """
+        :param name: a data.json entry name
+        :returns: pandas dataframe of the data.json entry
+        """
+        return self._load(name, lambda: pd.DataFrame(data=self.data[name]),
+                          persist=False)
+
+    def index(self, name):
+        """
+        Compiles a reference table into a LookupIndex on first use
+
+        :param name: a data.json entry name, 'hour_bins', 'sys_avg' or
+                     'r_grp'
+        :returns: a LookupIndex
+        """
+        if name not in self._indexes:
+            if name == 'hour_bins':
+                self._indexes[name] = LookupIndex(pd.DataFrame({
+                    'hr': list(self.data['hour_bins'].keys()),
+                    'time_bin': list(self.data['hour_bins'].values())}),
+                    ['hr'])
+            elif name == 'sys_avg':
+                self._indexes[name] = LookupIndex(
+                    self.sys_avg(), ['service_date', 'day_type'],
+                    ['sa', 'casa'])
+            elif name == 'r_grp':
+                self._indexes[name] = LookupIndex(
+                    self.r_grp(), ['seg'], ['r_grp'])
+            else:
+                key = next(
+                    key for entry, key, how, fill in JOINS.values()
+                    if entry == name)
+                self._indexes[name] = LookupIndex(self.lookup(name), [key])
+        return self._indexes[name]
+
+    def lookups(self, names):
+        """
+        Collects the lookup indexes joined to the datafile chunks
+
+        :param names: names of the lookup tables (see ReportPlan.joins)
+        :returns: a dict of LookupIndex objects keyed by name
+        """
+        return {name: self.index(name) for name in names}
+
+    def _load(self, name, loader, persist=True):
+        """
+        Returns a cached table, loading it on first use
+
+        :param name: name of the table
+        :param loader: function returning the table
+        :param persist: whether the table is kept on disk
+        :returns: pandas dataframe
+        """
+        if name not in self._tables:
+            path = None
+            if persist and self.directory:
+                path = os.path.join(
+                    self.directory, 'reference', f"{name}.parquet")
+            if path and os.path.exists(path) and not self.refresh:
+                self._tables[name] = pd.read_parquet(path)
+            else:
+                self._tables[name] = loader()
+                if path:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    self._tables[name].to_parquet(path, index=False)
+        return self._tables[name]
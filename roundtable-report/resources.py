@@ -0,0 +1,32 @@
+from importlib.resources import files
+import json
+import os
+
+# Environment variable naming a folder to read the JSON files from instead of
+# the package (e.g. the benchmark's synthetic configuration)
+CONFIG_ENV = 'ROUNDTABLE_REPORT_CONFIG'
+
+
+def resource_path(name):
+    """
+    Locates one of the JSON files shipped with the package, or kept in the
+    folder named by the CONFIG_ENV environment variable
+
+    :param name: filename of the resource (e.g. 'params.json')
+    :returns: path to the resource
+    """
+    if os.environ.get(CONFIG_ENV):
+        return os.path.join(os.environ[CONFIG_ENV], name)
+
+    return str(files('roundtable_report') / name)
+
+
+def load_json(name):
+    """
+    Loads one of the JSON files shipped with the package
+
+    :param name: filename of the resource (e.g. 'data.json')
+    :returns: the parsed contents of the file
+    """
+    with open(resource_path(name), 'r') as infile:
+        return json.load(infile)
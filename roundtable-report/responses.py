@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+
+def month_numbers(dates):
+    """
+    :param dates: pandas series of datetimes
+    :returns: numpy array of months since 1970-01 (0-based)
+    """
+    return dates.to_numpy().astype('datetime64[M]').astype(np.int64)
+
+
+def month_ends(months):
+    """
+    :param months: numpy array of months since 1970-01 (0-based)
+    :returns: numpy array of the month-end datetimes, as labelled by
+              resample('1M')
+    """
+    starts = months.astype('datetime64[M]')
+
+    return ((starts + 1).astype('datetime64[D]') - 1).astype('datetime64[ns]')
+
+
+def dense_months(table, keys, lag=12):
+    """
+    Sums the rides column by month for each group, filling the months
+    missing between a group's first and last month with 0, and adds the
+    rides of the month 'lag' months earlier in the same group
+
+    Equivalent to table.groupby(keys).resample('1M') followed by a grouped
+    shift(lag), without calling back into Python for every group.
+
+    :param table: pandas dataframe with the keys, 'service_date' and 'rides'
+                  columns
+    :param keys: list of columns the months are grouped by
+    :param lag: number of months looked back for the 'pre' column
+    :returns: pandas dataframe with the keys, 'service_date', 'rides' and
+              'pre' (NaN for a group's first 'lag' months) columns, sorted
+              by group and month
+    """
+    sums = table \
+        .assign(month=month_numbers(table['service_date'])) \
+        .groupby(keys + ['month'])['rides'] \
+        .sum() \
+        .reset_index()
+    if sums.empty:
+        return pd.DataFrame(columns=keys + ['service_date', 'rides', 'pre'])
+    bounds = sums.groupby(keys)['month'].agg(['min', 'max'])
+    lengths = (bounds['max'] - bounds['min'] + 1).to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    # Position of each month in the dense layout (groups in sorted order,
+    # months in order within a group)
+    group = sums.groupby(keys).ngroup().to_numpy()
+    first = bounds['min'].to_numpy()
+    rides = np.zeros(lengths.sum(), dtype=np.float64)
+    rides[offsets[group] + sums['month'].to_numpy() - first[group]] = \
+        sums['rides'].to_numpy()
+    step = np.arange(len(rides)) - np.repeat(offsets, lengths)
+    pre = np.full(len(rides), np.nan)
+    pre[step >= lag] = rides[np.flatnonzero(step >= lag) - lag]
+
+    dense = bounds.index.repeat(lengths).to_frame(index=False)
+    dense['service_date'] = month_ends(np.repeat(first, lengths) + step)
+    dense['rides'] = rides
+    dense['pre'] = pre
+
+    return dense
+
+
+def yoy(table, group_by, idx_col):
+    """
+    Computes the year-over-year responses of an aggregated table: monthly
+    rides for every idx_col value and their 'Total', the rides 12 months
+    earlier ('pre') and the raw ('diff') and percent ('pct_diff')
+    differences
+
+    :param table: aggregated pandas dataframe (see scan_datafile)
+    :param group_by: output of the report_group_by function
+    :param idx_col: the report's idx_col
+    :returns: pandas dataframe without the months lacking a 'pre' value
+    """
+    totals = dense_months(table, group_by[:-2])
+    totals[idx_col] = 'Total'
+    table = pd.concat(
+        [dense_months(table, group_by[:-1]), totals], sort=False) \
+        .reset_index(drop=True)
+    table = table[group_by + ['rides', 'pre']].dropna()
+    table['pct_diff'] = (table.rides / table.pre - 1) * 100
+    table['diff'] = table.rides - table.pre
+
+    return table
+
+
+def pct_of_total(table, idx_col):
+    """
+    Computes the share of each idx_col value in the rides of its type and
+    month, plus the 'Total' of the shares
+
+    :param table: aggregated pandas dataframe (see scan_datafile)
+    :param idx_col: the report's idx_col
+    :returns: pandas dataframe with 'type', 'service_date', idx_col and
+              'pct_of_total' columns
+    """
+    table = table[['type', 'service_date', idx_col, 'rides']] \
+        .sort_values(['type', 'service_date'], kind='stable')
+    totals = table.groupby(['type', 'service_date'])['rides']
+    table = table \
+        .assign(rides=table['rides'] / totals.transform('sum') * 100) \
+        .rename(columns={'rides': 'pct_of_total'}) \
+        .reset_index(drop=True)
+    totals = table.groupby(['type', 'service_date']) \
+        .agg({'pct_of_total': 'sum'}) \
+        .reset_index()
+    totals[idx_col] = 'Total'
+
+    return pd.concat([table, totals], sort=False).reset_index(drop=True)
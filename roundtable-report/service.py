@@ -0,0 +1,349 @@
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import importlib
+import json
+import os
+import time
+import traceback
+from urllib.parse import parse_qs, unquote, urlparse
+
+from roundtable_report import build
+from roundtable_report import config
+from roundtable_report import executor
+from roundtable_report import functions as rrf
+from roundtable_report import storage
+from roundtable_report.instrument import print_log
+
+
+class ReportService:
+    """
+    Keeps the state of report runs warm between requests: the configuration,
+    the database engine's connection pool, the reference tables, the
+    plotting libraries and the aggregated tables of every datafile scanned
+
+    The caches belong to the report month. They are dropped when the month
+    changes, and a datafile's aggregates are scanned again once the datafile
+    is replaced (e.g. a new month's data landed or a correction was queried).
+    A refresh also reloads the configuration and the reference tables.
+
+    :param directory: export path; data is read from and written to its
+                      data/ folder
+    :param fmt: datafile format used for query exports
+    :param query_workers: number of month shards queried at once
+    :param memory_limit: memory ceiling of the running aggregates of a
+                         datafile scan in MB (optional, unbounded if not
+                         given)
+    :param chunksize: number of rows per chunk fetched from the database or
+                      read from a datafile
+    """
+
+    def __init__(self, directory, fmt='parquet', query_workers=4,
+                 memory_limit=None, chunksize=storage.CHUNKSIZE):
+        self.export_path = directory
+        self.fmt = fmt
+        self.query_workers = query_workers
+        self.memory_limit = memory_limit
+        self.chunksize = chunksize
+        self.month = None
+        self.directory = None
+        self.reference = None
+        # Aggregated tables keyed by datafile, with the (modification time,
+        # size) of the datafile they were scanned from
+        self.aggregates = {}
+
+    def current_month(self):
+        """
+        Points the service to the report month's folder, dropping the caches
+        of the previous month
+
+        :returns: the report month folder
+        """
+        month = rrf.report_month()
+        if month != self.month:
+            self.month = month
+            self.directory = os.path.join(
+                self.export_path, 'data', month.strftime('%Y-%m'))
+            os.makedirs(self.directory, exist_ok=True)
+            self.reference = rrf.ReferenceCache(self.directory)
+            self.aggregates = {}
+            print_log(f"Serving the reports of {month:%Y-%m}")
+        return self.directory
+
+    def tables(self, datafile):
+        """
+        Returns the aggregated tables of every report built from a datafile,
+        scanning the datafile if it changed since the last scan
+
+        :param datafile: name of the datafile (a key in queries.json)
+        :returns: a dict of aggregated pandas dataframes keyed by report id
+        :raises FileNotFoundError: if the datafile wasn't exported
+        """
+        directory = self.current_month()
+        path = storage.find_datafile(directory, datafile, self.fmt)[0]
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if datafile not in self.aggregates or \
+                self.aggregates[datafile][0] != stamp:
+            reports = rrf.plan_scans(config.load().reports)[datafile]
+            print_log(f"Scanning {datafile}...")
+            self.aggregates[datafile] = (stamp, rrf.scan_datafile(
+                directory, datafile, reports, self.reference,
+                self.memory_limit, os.path.join(directory, '.spill'),
+                [self.month]))
+        return self.aggregates[datafile][1]
+
+    def warm(self):
+        """
+        Scans every datafile already exported for the report month and loads
+        the plotting libraries
+        """
+        # Imported here so the first request doesn't wait for them; only
+        # loaded, vis_data imports them where it uses them
+        for module in ['matplotlib.pyplot', 'seaborn']:
+            importlib.import_module(module)
+
+        directory = self.current_month()
+        for datafile in rrf.plan_scans(config.load().reports):
+            try:
+                storage.find_datafile(directory, datafile, self.fmt)
+            except FileNotFoundError:
+                continue
+            self.tables(datafile)
+
+    def build(self, id, label=None):
+        """
+        Pivots a report from the warm aggregates and renders its images (or
+        only one of them), recording a fully rendered report in the month's
+        build manifest
+
+        :param id: report id (a key in params.json)
+        :param label: label of the only image to render (optional)
+        :returns: a dict describing the images rendered, keyed by label
+        :raises KeyError: if the report or image doesn't exist
+        """
+        reports = config.load().reports
+        if id not in reports:
+            raise KeyError(f"'{id}' not in params.json")
+        plan = reports[id]
+        started = time.perf_counter()
+        table = self.tables(plan.datafile)[id]
+        directory = self.directory
+        pivot_tables = rrf.build_pivots(plan, directory, table, self.month)
+        tables = pivot_tables
+        if label is not None:
+            if label not in pivot_tables:
+                raise KeyError(f"'{label}' not an image of '{id}'")
+            tables = {label: pivot_tables[label]}
+        failures = rrf.vis_data(plan, directory, tables)
+        if label is None and not failures:
+            data = config.load().data
+            manifest = build.load_manifest(directory)
+            build.record(
+                manifest, directory, plan,
+                build.report_inputs(directory, plan, data, self.reference),
+                build.pivot_hash(pivot_tables), pivot_tables)
+            build.save_manifest(directory, manifest)
+
+        return {
+            'report': id,
+            'month': self.month.strftime('%Y-%m'),
+            'images': {
+                x: os.path.relpath(rrf.image_path(plan, directory, x),
+                                   directory)
+                for x, pivot_table in sorted(tables.items())
+                if len(pivot_table.index) > 0 and x not in failures},
+            'failures': failures,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+    def refresh(self, queries=None):
+        """
+        Reloads the configuration and the reference tables, runs queries
+        again and exports their datafiles, e.g. once a new month's data
+        landed, scanning each one again as soon as it is exported
+
+        The aggregates of every datafile are dropped, since they depend on
+        the configuration and the reference tables; the datafiles that
+        weren't queried again are scanned again on their next request.
+
+        :param queries: list of query names (optional, defaults to every
+                        query a report is built from)
+        :returns: a dict listing the datafiles exported
+        :raises KeyError: if a query doesn't exist
+        :raises ConfigError: if the edited configuration is invalid
+        """
+        directory = self.current_month()
+        config.load(refresh=True)
+        self.reference = rrf.ReferenceCache(directory, refresh=True)
+        self.aggregates = {}
+        scans = rrf.plan_scans(config.load().reports)
+        queries = queries or list(scans)
+        unknown = [x for x in queries if x not in config.load().queries]
+        if unknown:
+            raise KeyError(f"{', '.join(unknown)} not in queries.json")
+        started = time.perf_counter()
+        exported = []
+        for query in executor.run_queries(
+                queries, directory, self.fmt, self.query_workers,
+                rrf.params_25M(self.month), self.chunksize):
+            if query in scans:
+                self.tables(query)
+            exported.append(query)
+
+        return {
+            'month': self.month.strftime('%Y-%m'),
+            'exported': exported,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+    def status(self):
+        """
+        :returns: a dict listing the reports and whether their aggregates are
+                  warm
+        """
+        self.current_month()
+        return {
+            'month': self.month.strftime('%Y-%m'),
+            'reports': {
+                id: {'datafile': plan.datafile,
+                     'warm': plan.datafile in self.aggregates}
+                for id, plan in config.load().reports.items()}}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the requests of the HTTP endpoint from the server's ReportService
+
+        GET /reports: the reports and whether their aggregates are warm
+        POST /reports/{REPORT_ID}[?image=LABEL]: builds a report (or one of
+            its images)
+        POST /refresh[?query=NAME...]: reloads the configuration and the
+            reference tables and queries the datafiles again
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') in ('', '/reports'):
+            self.respond(self.server.service.status)
+        else:
+            self.reply(HTTPStatus.NOT_FOUND, {'error': f"No {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        service = self.server.service
+        if len(parts) == 2 and parts[0] == 'reports':
+            self.respond(
+                service.build, unquote(parts[1]),
+                args.get('image', [None])[0])
+        elif parts == ['refresh']:
+            self.respond(service.refresh, args.get('query'))
+        else:
+            self.reply(HTTPStatus.NOT_FOUND, {'error': f"No {url.path}"})
+
+    def respond(self, method, *args):
+        """
+        Replies with the outcome of a ReportService method
+        """
+        try:
+            body = method(*args)
+        except KeyError as e:
+            self.reply(HTTPStatus.NOT_FOUND, {'error': e.args[0]})
+        except FileNotFoundError as e:
+            self.reply(HTTPStatus.NOT_FOUND, {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.reply(HTTPStatus.INTERNAL_SERVER_ERROR,
+                       {'error': f"{type(e).__name__}: {e}"})
+        else:
+            self.reply(HTTPStatus.OK, body)
+
+    def reply(self, status, body):
+        """
+        Sends a JSON response
+        """
+        content = json.dumps(body, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        print_log(f"{self.address_string()} {format % args}")
+
+
+def serve(service, host='127.0.0.1', port=8050):
+    """
+    Serves a ReportService over HTTP until interrupted; requests are handled
+    one at a time
+
+    :param service: a ReportService
+    :param host: address to listen on
+    :param port: port to listen on
+    """
+    server = HTTPServer((host, port), RequestHandler)
+    server.service = service
+    print_log(f"Listening on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m roundtable_report.service',
+        description="Serves report builds from warm in-memory state over "
+                    "HTTP")
+    parser.add_argument(
+        'directory', help="export path; data is written to its data/ folder")
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument(
+        '--port', type=int, default=8050,
+        help="port to listen on (default: 8050)")
+    parser.add_argument(
+        '--format', dest='fmt', choices=storage.FORMATS, default='parquet',
+        help="datafile format used for query exports (default: parquet)")
+    parser.add_argument(
+        '--query-workers', type=int, default=4,
+        help="number of month shards queried at once (default: 4)")
+    parser.add_argument(
+        '--memory-limit', type=float, metavar='MB',
+        help="memory ceiling of the running aggregates of a datafile scan, "
+             "spilled to disk beyond it (default: unbounded)")
+    parser.add_argument(
+        '--chunksize', type=int, default=storage.CHUNKSIZE, metavar='N',
+        help="number of rows per chunk fetched from the database or read "
+             f"from a datafile (default: {storage.CHUNKSIZE})")
+
+    args = parser.parse_args(argv)
+    if args.chunksize <= 0:
+        parser.error("--chunksize must be positive")
+    if args.memory_limit is not None and args.memory_limit <= 0:
+        parser.error("--memory-limit must be positive")
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.exists(args.directory):
+        print(f"Path {args.directory} does not exist...exiting")
+        exit()
+    # Fail on a bad configuration before anything is served
+    try:
+        config.load()
+    except config.ConfigError as e:
+        print(e)
+        exit(1)
+    service = ReportService(
+        args.directory, args.fmt, args.query_workers, args.memory_limit,
+        args.chunksize)
+    # Scan the datafiles already exported before taking requests
+    service.warm()
+    serve(service, args.host, args.port)
@@ -0,0 +1,383 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from roundtable_report import config
+
+# Supported datafile formats, in order of preference when searching for an
+# existing export
+FORMATS = ['parquet', 'arrow', 'csv']
+CHUNKSIZE = 5 * 10**5
+# Number of fetched chunks queued for the writer thread of an export; the
+# next chunk is fetched while the previous one is written
+WRITE_BUFFER = 2
+
+
+def datafile_path(directory, name, fmt):
+    """
+    Builds the path of a local datafile
+
+    :param directory: directory containing the datafile
+    :param name: name of the query the datafile was exported from
+    :param fmt: one of the strings in FORMATS
+    :returns: path to the datafile
+    """
+    return os.path.join(directory, f"{name}.{fmt}")
+
+
+def arrow_schema(table):
+    """
+    Fixes the schema of a datafile from its first chunk, typing the columns
+    that only hold nulls in it after the queries.json column contract
+    (strings if not in it), so that later chunks holding values can be cast
+    to the schema
+
+    :param table: pyarrow table converted from the first chunk
+    :returns: a pyarrow schema
+    """
+    fields = []
+    for field in table.schema:
+        if pa.types.is_null(field.type):
+            dtype = np.dtype(config.COLUMN_DTYPES.get(field.name, 'object'))
+            field = field.with_type(
+                pa.string() if dtype == object else
+                pa.from_numpy_dtype(dtype))
+        fields.append(field)
+
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def find_datafile(directory, name, fmt=None):
+    """
+    Locates an existing datafile, checking the requested format first and
+    falling back to the other supported formats
+
+    :param directory: directory containing the datafile
+    :param name: name of the query the datafile was exported from
+    :param fmt: preferred format (optional)
+    :returns: a (path, format) tuple
+    """
+    formats = ([fmt] if fmt else []) + [x for x in FORMATS if x != fmt]
+    for candidate in formats:
+        path = datafile_path(directory, name, candidate)
+        if os.path.exists(path):
+            return path, candidate
+    raise FileNotFoundError(
+        f"No datafile for '{name}' found in {directory}")
+
+
+class ChunkWriter:
+    """
+    Writes dataframes one at a time to a single local datafile
+
+    Parquet and Arrow IPC files keep the column dtypes of the first chunk
+    holding rows (see arrow_schema); later chunks are cast to the same
+    schema, and empty chunks are only written if no other chunk is. CSV
+    files are written with the dataframe index, as the original exports
+    were. No file is created if no chunk is written.
+
+    :param directory: destination directory to export data to
+    :param name: name of query (and filename to export)
+    :param fmt: one of the strings in FORMATS
+    """
+
+    def __init__(self, directory, name, fmt='parquet'):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported datafile format '{fmt}'")
+        self.path = datafile_path(directory, name, fmt)
+        self.fmt = fmt
+        self._writer = self._schema = self._empty = None
+
+    def write(self, chunk):
+        """
+        :param chunk: pandas dataframe to append to the datafile
+        """
+        if self.fmt == 'csv':
+            if self._writer is None:
+                self._writer = open(self.path, 'w', newline='')
+                chunk.to_csv(self._writer)
+            else:
+                chunk.to_csv(self._writer, header=False)
+            return
+
+        if self._writer is None:
+            if len(chunk) == 0:
+                # An empty chunk (e.g. a month shard without rows) can't type
+                # the columns holding strings
+                self._empty = chunk
+                return
+            self._open(chunk)
+        self._writer.write_table(pa.Table.from_pandas(
+            chunk, schema=self._schema, preserve_index=False))
+
+    def close(self):
+        """
+        Finalizes the datafile
+        """
+        if self._writer is None and self._empty is not None:
+            # Only empty chunks were written
+            self._open(self._empty)
+            self._writer.write_table(pa.Table.from_pandas(
+                self._empty, schema=self._schema, preserve_index=False))
+        self._empty = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _open(self, chunk):
+        """
+        Creates the datafile with the schema of its first chunk
+        """
+        self._schema = arrow_schema(
+            pa.Table.from_pandas(chunk, preserve_index=False))
+        if self.fmt == 'parquet':
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        else:
+            self._writer = pa.ipc.new_file(self.path, self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_chunks(chunks, directory, name, fmt='parquet', buffer=0):
+    """
+    Writes an iterable of dataframes to a single local datafile
+
+    Given a buffer, the dataframes are handed to a writer thread through a
+    queue holding at most that many of them, so that the next dataframe is
+    produced (e.g. fetched from the database) while the previous ones are
+    written; an exception raised by the writer is raised again once the
+    iterable stops being read.
+
+    :param chunks: iterable of pandas dataframes
+    :param directory: destination directory to export data to
+    :param name: name of query (and filename to export)
+    :param fmt: one of the strings in FORMATS
+    :param buffer: number of dataframes queued for the writer thread
+                   (optional, written as they are produced if 0)
+    :returns: path to the datafile
+    """
+    if buffer:
+        return _write_behind(chunks, directory, name, fmt, buffer)
+    with ChunkWriter(directory, name, fmt) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    return writer.path
+
+
+def _write_behind(chunks, directory, name, fmt, buffer):
+    """
+    Writes an iterable of dataframes to a single local datafile on a writer
+    thread (see write_chunks)
+    """
+    writer = ChunkWriter(directory, name, fmt)
+    pending = queue.Queue(maxsize=buffer)
+    errors = []
+
+    def write():
+        # Ends on None; after an error, keeps emptying the queue so that the
+        # producer never blocks on it
+        chunk = pending.get()
+        try:
+            with writer:
+                while chunk is not None:
+                    writer.write(chunk)
+                    chunk = pending.get()
+        except Exception as e:
+            errors.append(e)
+            while chunk is not None:
+                chunk = pending.get()
+
+    thread = threading.Thread(target=write, name=f"write {name}")
+    thread.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            pending.put(chunk)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    return writer.path
+
+
+def tee_chunks(chunks, directory, name, fmt='parquet'):
+    """
+    Passes an iterable of dataframes through while also writing it to a
+    local datafile, which is only created once the iterable is exhausted
+
+    :param chunks: iterable of pandas dataframes
+    :param directory: destination directory to export data to
+    :param name: name of query (and filename to export)
+    :param fmt: one of the strings in FORMATS
+    :returns: an iterator of the same dataframes
+    """
+    # Written under a temporary name, so that a failed or abandoned pass
+    # doesn't leave a partial datafile behind
+    temp = datafile_path(directory, f".{name}", fmt)
+    try:
+        with ChunkWriter(directory, f".{name}", fmt) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    if os.path.exists(temp):
+        os.replace(temp, datafile_path(directory, name, fmt))
+
+
+def parse_dates(chunk):
+    """
+    Converts the 'service_date' column of a chunk to datetimes if needed
+
+    :param chunk: pandas dataframe
+    :returns: the same pandas dataframe
+    """
+    if not pd.api.types.is_datetime64_any_dtype(chunk['service_date']):
+        chunk['service_date'] = pd.to_datetime(
+            chunk['service_date'], format='%Y-%m-%d')
+
+    return chunk
+
+
+def window_bounds(windows):
+    """
+    :param windows: list of dicts with 'from_date' and 'to_date' entries
+                    formatted as '%Y%m%d' (see functions.scan_windows)
+    :returns: a list of (start, end) pandas timestamps, the end excluded
+    """
+    return [
+        (pd.Timestamp(window['from_date']),
+         pd.Timestamp(window['to_date']) + pd.Timedelta(days=1))
+        for window in windows]
+
+
+def window_mask(dates, windows):
+    """
+    :param dates: pandas series of datetimes
+    :param windows: list of dicts with 'from_date' and 'to_date' entries
+                    formatted as '%Y%m%d' (see functions.scan_windows)
+    :returns: boolean numpy array, true for the dates within one of the
+              windows
+    """
+    dates = pd.DatetimeIndex(dates)
+    mask = np.zeros(len(dates), dtype=bool)
+    for start, end in window_bounds(windows):
+        mask |= (dates >= start) & (dates < end)
+
+    return mask
+
+
+def read_chunks(directory, name, columns=None, chunksize=CHUNKSIZE,
+                fmt=None, windows=None):
+    """
+    Reads a local datafile piecewise
+
+    Only the requested columns are read from Parquet and Arrow IPC files;
+    'service_date' is always returned as a datetime column. Given service
+    date windows, only the rows within them are returned: the Parquet row
+    groups outside of them are skipped and the other rows of Arrow IPC
+    files are dropped before being converted to pandas.
+
+    :param directory: directory containing the datafile
+    :param name: name of the query the datafile was exported from
+    :param columns: list of columns to read (optional, defaults to all)
+    :param chunksize: number of rows per chunk
+    :param fmt: preferred format (optional)
+    :param windows: list of dicts with 'from_date' and 'to_date' entries
+                    formatted as '%Y%m%d' (optional, defaults to every row)
+    :returns: an iterator of pandas dataframes
+    """
+    path, fmt = find_datafile(directory, name, fmt)
+    if fmt == 'parquet':
+        source = pq.ParquetFile(path)
+        batches = (
+            batch.to_pandas() for batch in source.iter_batches(
+                batch_size=chunksize, columns=columns,
+                row_groups=_row_groups(source, windows)))
+    elif fmt == 'arrow':
+        batches = _read_arrow(path, columns, chunksize, windows)
+    else:
+        batches = pd.read_csv(
+            path,
+            usecols=(lambda col: col in columns) if columns else None,
+            chunksize=chunksize)
+    for chunk in batches:
+        chunk = parse_dates(chunk)
+        if windows is not None:
+            chunk = chunk[window_mask(chunk['service_date'], windows)]
+            if chunk.empty:
+                continue
+        yield chunk
+
+
+def _row_groups(source, windows):
+    """
+    Lists the row groups of a Parquet file whose service_date statistics
+    overlap the windows
+
+    :param source: a pyarrow ParquetFile
+    :param windows: list of dicts with 'from_date' and 'to_date' entries
+                    formatted as '%Y%m%d' (optional, defaults to every row)
+    :returns: a list of row group numbers
+    """
+    row_groups = range(source.metadata.num_row_groups)
+    if windows is None or \
+            'service_date' not in source.schema_arrow.names:
+        return list(row_groups)
+    col = source.schema_arrow.get_field_index('service_date')
+    bounds = window_bounds(windows)
+    kept = []
+    for i in row_groups:
+        stats = source.metadata.row_group(i).column(col).statistics
+        try:
+            first, last = pd.Timestamp(stats.min), pd.Timestamp(stats.max)
+        except (AttributeError, TypeError, ValueError):
+            # No usable statistics (e.g. dates stored as text)
+            kept.append(i)
+            continue
+        if any(first < end and last >= start for start, end in bounds):
+            kept.append(i)
+
+    return kept
+
+
+def _read_arrow(path, columns, chunksize, windows=None):
+    """
+    Reads slices of a memory-mapped Arrow IPC file
+
+    :param path: path to the datafile
+    :param columns: list of columns to read (optional, defaults to all)
+    :param chunksize: number of rows per chunk
+    :param windows: list of dicts with 'from_date' and 'to_date' entries
+                    formatted as '%Y%m%d' (optional, defaults to every row)
+    :returns: an iterator of pandas dataframes
+    """
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        filtered = windows is not None and \
+            'service_date' in table.column_names
+        # Select first, so that the filter only copies the columns read
+        if columns:
+            table = table.select(
+                list(columns) + ['service_date']
+                if filtered and 'service_date' not in columns else columns)
+        if filtered:
+            table = table.filter(pa.array(window_mask(
+                table.column('service_date').to_pandas(), windows)))
+        for offset in range(0, table.num_rows, chunksize):
+            yield table.slice(offset, chunksize).to_pandas()
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from roundtable_report import functions as rrf
+from roundtable_report.reference import LookupIndex
+
+
+@pytest.fixture
+def rows():
+    """
+    Synthetic datafile rows, a third of them rail and some bus routes
+    without a route group
+    """
+    rng = np.random.default_rng(0)
+    size = 1000
+    return pd.DataFrame({
+        'type': rng.choice(['bus', 'rail'], size, p=[2 / 3, 1 / 3]),
+        'seg': rng.choice(
+            [str(x) for x in range(1, 21)] + ['Red', 'Blue'], size),
+        'day_type': rng.choice(['W', 'A', 'U'], size),
+        'fm_grp': rng.choice(['Full Fare', 'Reduced', 'Free'], size),
+        'rides': rng.random(size) * 100})
+
+
+def test_route_group_substitution(rows):
+    # Routes 16 to 20 have no route group
+    r_grp = pd.DataFrame({
+        'seg': [str(x) for x in range(1, 16)],
+        'r_grp': [f"Group {x % 4}" for x in range(1, 16)]})
+    expected = pd.merge(rows, r_grp, on=['seg'], how='left')
+    expected = expected.apply(
+        lambda row: row.r_grp if row.type == 'bus' else row.seg, axis=1)
+
+    chunk = rrf.enrich_chunk(
+        rows.copy(), {'r_grp': LookupIndex(r_grp, ['seg'], ['r_grp'])})
+
+    assert expected.isna().any()
+    pd.testing.assert_series_equal(
+        chunk['seg'], expected, check_names=False)
+
+
+@pytest.mark.parametrize('split_col', [
+    [], ['type'], ['type', 'day_type'], ['type', 'day_type', 'fm_grp']])
+def test_join_columns(rows, split_col):
+    expected = rows.apply(
+        lambda row: ' - '.join([row[col] for col in split_col]), axis=1)
+
+    key = rrf.join_columns(rows, split_col, ' - ')
+
+    pd.testing.assert_series_equal(key, expected, check_names=False)
@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+import pytest
+
+from roundtable_report import benchmark
+from roundtable_report import config
+from roundtable_report import db
+from roundtable_report import functions as rrf
+from roundtable_report import pushdown
+from roundtable_report.reference import ReferenceCache
+from roundtable_report.resources import CONFIG_ENV
+
+
+@pytest.fixture(scope='module')
+def reports(tmp_path_factory):
+    """
+    Points the package at the benchmark's synthetic configuration and
+    SQLite stand-in of the database
+
+    :returns: the report plans grouped by datafile (see plan_scans)
+    """
+    previous = os.environ.get(CONFIG_ENV)
+    benchmark.setup(
+        str(tmp_path_factory.mktemp('bench')), rows=5000, segs=12, media=6)
+    db.dispose()
+    yield rrf.plan_scans(config.load(refresh=True).reports)
+    db.dispose()
+    if previous is None:
+        del os.environ[CONFIG_ENV]
+    else:
+        os.environ[CONFIG_ENV] = previous
+
+
+def sort_table(table, plan):
+    """
+    :returns: the aggregated table in group-by order, with a fresh index
+    """
+    group_by = list(plan.group_by)
+    table = table[group_by + ['rides']].copy()
+    table['rides'] = table['rides'].astype('float64')
+
+    return table.sort_values(group_by).reset_index(drop=True)
+
+
+def test_pushdown_matches_pandas(reports):
+    for datafile, plans in reports.items():
+        pushed = pushdown.aggregate_query(
+            datafile, plans, ReferenceCache(), workers=1)
+        scanned = rrf.aggregate_chunks(
+            rrf.query_data(datafile), plans, ReferenceCache())
+        for id, plan in plans.items():
+            assert len(scanned[id]) > 0, id
+            pd.testing.assert_frame_equal(
+                sort_table(pushed[id], plan), sort_table(scanned[id], plan),
+                check_dtype=False, obj=id)
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from roundtable_report import responses
+
+
+def empty_table():
+    return pd.DataFrame({
+        'type': pd.Series(dtype=object),
+        'day_type': pd.Series(dtype=object),
+        'service_date': pd.Series(dtype='datetime64[ns]'),
+        'rides': pd.Series(dtype='float64')})
+
+
+def test_dense_months_empty():
+    dense = responses.dense_months(empty_table(), ['type', 'day_type'])
+
+    assert dense.empty
+    assert list(dense.columns) == \
+        ['type', 'day_type', 'service_date', 'rides', 'pre']
+
+
+def test_yoy_empty():
+    table = responses.yoy(
+        empty_table(), ['type', 'day_type', 'service_date'], 'day_type')
+
+    assert table.empty
+
+
+@pytest.fixture
+def table():
+    """
+    Synthetic aggregated table over 30 months, with months missing from
+    some of the groups
+    """
+    rng = np.random.default_rng(0)
+    size = 400
+    days = pd.date_range('2024-01-01', '2026-06-30')
+    return pd.DataFrame({
+        'type': rng.choice(['bus', 'rail'], size),
+        'day_type': rng.choice(['W', 'A', 'U'], size, p=[0.8, 0.15, 0.05]),
+        'service_date': rng.choice(days, size),
+        'rides': rng.integers(1, 1000, size).astype('float64')})
+
+
+def sort(table, keys):
+    return table.sort_values(keys).reset_index(drop=True)
+
+
+def test_yoy(table):
+    group_by = ['type', 'day_type', 'service_date']
+    # The per-group resample and shift yoy replaced
+    indexed = table.set_index('service_date')
+    totals = indexed \
+        .groupby(group_by[:-2]) \
+        .resample('1M')['rides'] \
+        .sum() \
+        .fillna(0) \
+        .reset_index()
+    totals['day_type'] = 'Total'
+    expected = indexed \
+        .groupby(group_by[:-1]) \
+        .resample('1M')['rides'] \
+        .sum() \
+        .fillna(0) \
+        .reset_index()
+    expected = pd.concat([expected, totals], sort=False) \
+        .reset_index(drop=True)
+    expected['pre'] = expected \
+        .sort_values(group_by) \
+        .groupby(group_by[:-1])['rides'] \
+        .shift(12)
+    expected.dropna(inplace=True)
+    expected['pct_diff'] = (expected.rides / expected.pre - 1) * 100
+    expected['diff'] = expected.rides - expected.pre
+
+    result = responses.yoy(table, group_by, 'day_type')
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(
+        sort(result, group_by), sort(expected[result.columns], group_by))
+
+
+def test_pct_of_total(table):
+    keys = ['type', 'service_date', 'day_type']
+    table = table.groupby(keys, as_index=False)['rides'].sum()
+    # The per-group apply pct_of_total replaced
+    expected = table.set_index(keys) \
+        .groupby(level=[0, 1], as_index=False) \
+        .apply(lambda row: row['rides'] / row['rides'].sum() * 100) \
+        .reset_index(level=keys) \
+        .reset_index(drop=True) \
+        .rename(columns={'rides': 'pct_of_total'})
+    totals = expected.groupby(['type', 'service_date']) \
+        .agg({'pct_of_total': 'sum'}) \
+        .reset_index()
+    totals['day_type'] = 'Total'
+    expected = pd.concat([expected, totals], sort=False)
+
+    result = responses.pct_of_total(table, 'day_type')
+
+    pd.testing.assert_frame_equal(
+        sort(result, keys), sort(expected[result.columns], keys))